@@ -0,0 +1,195 @@
+# pylint: disable=C0103
+
+# Stand-in for klippy's API socket, speaking its \x03-framed JSON protocol.
+# Alternates print_stats (or the gcode state) between states at a fixed rate
+# and records when each change was pushed. time.monotonic() is used, which
+# is comparable across processes.
+
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+
+argParser = argparse.ArgumentParser(prog="Fake klippy socket server")
+argParser.add_argument("-s", "--socket", required=True)
+argParser.add_argument(
+    "-r", "--rate", type=float, default=5.0, help="State changes per second"
+)
+argParser.add_argument("-d", "--duration", type=float, default=5.0)
+argParser.add_argument(
+    "--source",
+    choices=("print", "gcode"),
+    default="print",
+    help="Change print_stats or call the set_status_led remote method",
+)
+argParser.add_argument("--states", default="printing,paused")
+argParser.add_argument("--pushes", help="Write push timestamps to this JSON file")
+
+
+class FakeKlippy:
+    def __init__(self, socketPath, states):
+        self.socketPath = socketPath
+        self.states = states
+        self.printState = states[0]
+
+        self.clients = []
+        self.subscriptions = {}
+        self.remoteMethods = {}
+
+        # (time.monotonic(), state) of each pushed change
+        self.pushes = []
+        self.numRequests = 0
+
+    def statusOf(self, objects):
+        available = {
+            "webhooks": {"state": "ready", "state_message": "Printer is ready"},
+            "print_stats": {"state": self.printState},
+        }
+        return {
+            name: {
+                key: value
+                for key, value in available.get(name, {}).items()
+                if not fields or key in fields
+            }
+            for name, fields in objects.items()
+        }
+
+    def send(self, writer, message):
+        writer.write(json.dumps(message).encode() + b"\x03")
+
+    def handleRequest(self, writer, request):
+        self.numRequests += 1
+        method = request.get("method")
+        params = request.get("params", {})
+
+        if method == "info":
+            result = {"state": "ready", "state_message": "Printer is ready"}
+        elif method == "objects/query":
+            result = {
+                "eventtime": time.monotonic(),
+                "status": self.statusOf(params["objects"]),
+            }
+        elif method == "objects/subscribe":
+            self.subscriptions[writer] = (
+                params["objects"],
+                params.get("response_template", {}),
+            )
+            result = {
+                "eventtime": time.monotonic(),
+                "status": self.statusOf(params["objects"]),
+            }
+        elif method == "register_remote_method":
+            self.remoteMethods[params["remote_method"]] = (
+                writer,
+                params["response_template"],
+            )
+            result = {}
+        else:
+            self.send(
+                writer,
+                {
+                    "id": request["id"],
+                    "error": {"error": "WebRequestError", "message": "Unknown method"},
+                },
+            )
+            return
+
+        self.send(writer, {"id": request["id"], "result": result})
+
+    async def handleClient(self, reader, writer):
+        self.clients.append(writer)
+        data = b""
+        try:
+            while True:
+                chunk = await reader.read(65536)
+                if not chunk:
+                    break
+                data += chunk
+                *messages, data = data.split(b"\x03")
+                for message in messages:
+                    self.handleRequest(writer, json.loads(message))
+        finally:
+            self.clients.remove(writer)
+            self.subscriptions.pop(writer, None)
+            writer.close()
+
+    def setPrintState(self, state):
+        self.printState = state
+        self.pushes.append((time.monotonic(), state))
+
+        for writer, (objects, template) in self.subscriptions.items():
+            if "print_stats" in objects:
+                self.send(
+                    writer,
+                    dict(
+                        template,
+                        params={
+                            "eventtime": time.monotonic(),
+                            "status": {"print_stats": {"state": state}},
+                        },
+                    ),
+                )
+
+    def callRemoteMethod(self, method, **params):
+        writer, template = self.remoteMethods[method]
+        self.send(writer, dict(template, params=params))
+
+    async def start(self):
+        if os.path.exists(self.socketPath):
+            os.unlink(self.socketPath)
+        self.server = await asyncio.start_unix_server(
+            self.handleClient, self.socketPath
+        )
+
+    def setGcodeState(self, state):
+        self.pushes.append((time.monotonic(), state))
+        self.callRemoteMethod("set_status_led", state=state)
+
+    async def runScript(self, rate, duration, source="print"):
+        # Wait for a client to subscribe before changing states
+        while not self.subscriptions or (
+            source == "gcode" and "set_status_led" not in self.remoteMethods
+        ):
+            await asyncio.sleep(0.01)
+
+        nextTime = time.monotonic()
+        endTime = nextTime + duration
+        index = 0
+        while nextTime < endTime:
+            index += 1
+            state = self.states[index % len(self.states)]
+            if source == "gcode":
+                self.setGcodeState(state)
+            else:
+                self.setPrintState(state)
+
+            nextTime += 1.0 / rate
+            await asyncio.sleep(max(0, nextTime - time.monotonic()))
+
+    def close(self):
+        self.server.close()
+        for writer in list(self.clients):
+            writer.close()
+        if os.path.exists(self.socketPath):
+            os.unlink(self.socketPath)
+
+
+async def serve(args):
+    klippy = FakeKlippy(args.socket, args.states.split(","))
+    await klippy.start()
+    try:
+        await klippy.runScript(args.rate, args.duration, args.source)
+    finally:
+        klippy.close()
+        # Let the client handlers see the closed connections
+        await asyncio.sleep(0.1)
+
+    if args.pushes:
+        with open(args.pushes, "w", encoding="utf-8") as file:
+            json.dump({"pushes": klippy.pushes, "requests": klippy.numRequests}, file)
+
+
+if __name__ == "__main__":
+    asyncio.run(serve(argParser.parse_args(sys.argv[1:])))
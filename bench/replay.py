@@ -0,0 +1,280 @@
+# pylint: disable=C0103
+
+# Replays a recording of main.py --record through StatusMonitor.handleMessage,
+# with the LED outputs replaced by a sink which keeps every shown frame.
+# Reports the processing time per kind of message, and writes the frames for
+# diffing the output of two versions on the same trace.
+#
+#   python main.py --record trace.jsonl
+#   python bench/replay.py trace.jsonl -c status_led.cfg --frames frames.jsonl
+#   python bench/replay.py trace.jsonl -c status_led.cfg --speed 1
+
+import os
+import sys
+import json
+import time
+import asyncio
+import logging
+import argparse
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+# pylint: disable=C0413
+from config import StatusLEDConfig
+from clock import FrameClock
+from led import AnimatedLED
+from led import ANIMATE_STEP_S
+from led import LATE_FRAME_THRESHOLD_S
+from main import StatusMonitor
+from recording import readRecording
+from run import percentile
+
+# Requests sent by the replaying monitors get ids far above the recorded ones
+REPLAY_REQUEST_ID_OFFSET = 1000000000
+
+argParser = argparse.ArgumentParser(prog="Klipper Status LED replay")
+argParser.add_argument("recording")
+argParser.add_argument("-c", "--config", required=True)
+argParser.add_argument(
+    "--speed",
+    type=float,
+    default=0.0,
+    help="replay speed, 0 replays as fast as possible on a virtual clock",
+)
+argParser.add_argument(
+    "--tail", type=float, default=1.0, help="seconds to render after the last message"
+)
+argParser.add_argument("--frames", help="Write the shown frames to this file")
+
+
+# Frames of the virtual clock only depend on the recording,
+# so that two versions show the same frames at the same times
+class VirtualClock(FrameClock):
+    def __init__(self):
+        super().__init__(ANIMATE_STEP_S, LATE_FRAME_THRESHOLD_S)
+        self.time = 0.0
+
+    def now(self):
+        return self.time
+
+
+# Stands in for the asyncio.Event which wakes AnimatedLED.run()
+class WakeFlag:
+    def __init__(self):
+        self.isSet = False
+
+    def set(self):
+        self.isSet = True
+
+    def clear(self):
+        self.isSet = False
+
+
+class RecordingOutput:
+    def __init__(self, replay):
+        self.replay = replay
+        # (time since the start of the replay, frame) of each shown frame
+        self.frames = []
+
+    def show(self, buf):
+        if self.replay.startTime is not None:
+            self.frames.append(
+                (self.replay.led.clock.now() - self.replay.startTime, bytes(buf))
+            )
+
+
+class NullSocket:
+    def send(self, data):
+        return len(data)
+
+    def close(self):
+        pass
+
+
+class Replay:
+    def __init__(self, config, entries, isVirtual):
+        self.entries = entries
+        self.startTime = None
+
+        self.outputs = []
+        self.led = AnimatedLED(config, self.createOutput)
+        if isVirtual:
+            self.led.clock = VirtualClock()
+            self.led.wakeEvent = WakeFlag()
+        self.nextTime = None
+
+        self.monitors = {}
+        for printer in config.parsedPrinters:
+            monitor = StatusMonitor(config, "", self.led, printer)
+            monitor.sock = NullSocket()
+            monitor.requests.nextId = REPLAY_REQUEST_ID_OFFSET
+            self.monitors[monitor.printerName] = monitor
+
+        self.requestMethods = {}
+        self.messageTimes = {}
+        self.numStateChanges = 0
+
+    def createOutput(self, outputType, options, count, bpp):
+        output = RecordingOutput(self)
+        self.outputs.append(output)
+        return output
+
+    def apply(self, entry):
+        monitor = self.monitors.get(entry["printer"])
+        if monitor is None:
+            return
+
+        if entry.get("event") == "connected":
+            monitor.isConnected = True
+            monitor.onConnected()
+        elif entry.get("event") == "disconnected":
+            monitor.onDisconnected()
+        elif "send" in entry:
+            self.requestMethods[entry["id"]] = entry["send"]
+            monitor.requests.expect(
+                entry["id"], entry["send"], monitor.getResponseHandler(entry["send"])
+            )
+        elif "recv" in entry:
+            data = entry["recv"].encode()
+            lastState = monitor.currentState
+
+            startTime = time.perf_counter()
+            monitor.handleMessage(data)
+            duration = time.perf_counter() - startTime
+
+            if monitor.currentState != lastState:
+                self.numStateChanges += 1
+            self.messageTimes.setdefault(self.messageKind(data), []).append(duration)
+
+    def messageKind(self, data):
+        message = json.loads(data)
+        if "action" in message:
+            return message["action"]
+        return "response " + self.requestMethods.get(message.get("id"), "unknown")
+
+    # Renders and shows one frame like AnimatedLED.run()
+    def renderFrame(self):
+        self.nextTime, changedChains = self.led.renderNextFrame()
+        for chainIndex in changedChains:
+            self.led.chains[chainIndex].show()
+
+    # Renders all frames due until the time on the virtual clock,
+    # waking up when AnimatedLED.run() would
+    def advanceTo(self, t):
+        clock = self.led.clock
+        while True:
+            due = self.nextTime
+            if self.led.forceUpdate:
+                forcedTime = self.led.getForcedRenderTime(clock.time)
+                due = forcedTime if due is None else min(due, forcedTime)
+            elif self.led.wakeEvent.isSet:
+                due = clock.time
+
+            if due is None or due > t:
+                break
+            clock.time = max(clock.time, due)
+            self.renderFrame()
+
+        clock.time = max(clock.time, t)
+
+    def runVirtual(self, tail):
+        self.startTime = 0.0
+        firstTime = self.entries[0]["t"] if self.entries else 0.0
+
+        for entry in self.entries:
+            self.advanceTo(entry["t"] - firstTime)
+            self.apply(entry)
+        self.advanceTo(self.led.clock.time + tail)
+
+    async def runRealtime(self, speed, tail):
+        loop = asyncio.get_running_loop()
+        ledTask = asyncio.create_task(self.led.run())
+
+        self.startTime = self.led.clock.now()
+        startLoopTime = loop.time()
+        firstTime = self.entries[0]["t"] if self.entries else 0.0
+
+        for entry in self.entries:
+            delay = startLoopTime + (entry["t"] - firstTime) / speed - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self.apply(entry)
+        await asyncio.sleep(tail)
+
+        ledTask.cancel()
+        try:
+            await ledTask
+        except asyncio.CancelledError:
+            pass
+
+    def writeFrames(self, path):
+        with open(path, "w", encoding="utf-8") as file:
+            for chain, output in zip(self.led.chains, self.outputs):
+                for t, frame in output.frames:
+                    file.write(
+                        json.dumps(
+                            {
+                                "t": round(t, 4),
+                                "chain": chain.name,
+                                "frame": frame.hex(),
+                            }
+                        )
+                        + "\n"
+                    )
+
+    def printReport(self):
+        print(
+            "%-32s %7s %9s %9s %9s %9s"
+            % ("message", "count", "mean", "p50", "p99", "max")
+        )
+        for kind, times in sorted(self.messageTimes.items()):
+            print(
+                "%-32s %7d %7.1fus %7.1fus %7.1fus %7.1fus"
+                % (
+                    kind,
+                    len(times),
+                    sum(times) / len(times) * 1e6,
+                    percentile(times, 0.5) * 1e6,
+                    percentile(times, 0.99) * 1e6,
+                    max(times) * 1e6,
+                )
+            )
+
+        print("state changes: %d" % self.numStateChanges)
+        for chain, output in zip(self.led.chains, self.outputs):
+            print("chain %s: %d frames" % (chain.name, len(output.frames)))
+
+
+def main():
+    args = argParser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    config = StatusLEDConfig()
+    config.load(args.config)
+    entries = readRecording(args.recording)
+
+    unknownPrinters = {entry["printer"] for entry in entries} - {
+        printer["name"] for printer in config.parsedPrinters
+    }
+    if unknownPrinters:
+        logging.warning(
+            "Skipping printers not in the config: %s",
+            ", ".join(sorted(unknownPrinters)),
+        )
+
+    replay = Replay(config, entries, args.speed <= 0)
+    if args.speed <= 0:
+        replay.runVirtual(args.tail)
+    else:
+        asyncio.run(replay.runRealtime(args.speed, args.tail))
+    replay.led.close()
+
+    replay.printReport()
+    if args.frames:
+        replay.writeFrames(args.frames)
+
+
+if __name__ == "__main__":
+    main()
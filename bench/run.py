@@ -0,0 +1,326 @@
+# pylint: disable=C0103
+
+# Benchmark runner: drives StatusMonitor against bench/fake_klippy.py with an
+# in-memory LED output and reports state-change-to-show() latency, CPU time
+# per frame, frame rate and memory for a sweep of strip layouts.
+#
+#   python bench/run.py --chains 1,300 --anims solid,ease --json results.json
+#   python bench/run.py --compare results.json
+
+import os
+import sys
+import json
+import time
+import asyncio
+import logging
+import argparse
+import tempfile
+import resource
+import subprocess
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+# pylint: disable=C0413
+from config import StatusLEDConfig
+from led import AnimatedLED
+from led import encodePixel
+from main import StatusMonitor
+
+FAKE_KLIPPY_PATH = os.path.join(BENCH_DIR, "fake_klippy.py")
+
+ANIM_MIXES = {
+    "solid": ("solid",),
+    "blink": ("blink",),
+    "ease": ("ease",),
+    "mixed": ("solid", "blink", "alternate", "ease", "ease-alternate"),
+    "effects": ("chase", "comet", "rainbow", "gradient", "twinkle"),
+}
+SECTION_COLORS = ("0, 1, 0", "1, 1, 0", "0, 1, 1", "1, 0, 1", "1, 1, 1")
+# Solid colors of the marker pixel, one per scripted state
+MARKER_COLORS = ((1, 0, 0), (0, 0, 1))
+STATE_NAMES = {
+    "print": ("printing", "paused"),
+    "gcode": ("bench_a", "bench_b"),
+}
+
+# Relative increase of a metric that counts as a regression in --compare
+REGRESSION_TOLERANCE = 0.25
+
+argParser = argparse.ArgumentParser(prog="Klipper Status LED benchmark")
+argParser.add_argument("--chains", default="1,10,100,300,1000")
+argParser.add_argument("--sections", default="1,4,16")
+argParser.add_argument("--anims", default=",".join(ANIM_MIXES))
+argParser.add_argument("--source", choices=tuple(STATE_NAMES), default="print")
+argParser.add_argument("-r", "--rate", type=float, default=5.0)
+argParser.add_argument("-d", "--duration", type=float, default=3.0)
+argParser.add_argument("--json", help="Write results to this file")
+argParser.add_argument("--compare", help="Compare against a previous --json file")
+
+
+class MemoryOutput:
+    def __init__(self, bpp):
+        self.bpp = bpp
+        # (time.monotonic(), first pixel) of each shown frame
+        self.shows = []
+        self.frame = None
+
+    def show(self, buf):
+        self.shows.append((time.monotonic(), bytes(buf[: self.bpp])))
+        self.frame = buf
+
+
+def makeConfig(chainCount, numSections, anims, source):
+    prefix = "print_" if source == "print" else "gcode_"
+    stateNames = [prefix + name for name in STATE_NAMES[source]]
+
+    lines = [
+        "[status_led]",
+        "pin: D18",
+        "chain_count: %d" % chainCount,
+        "update_mode: subscribe",
+        "",
+        "[section marker]",
+        "bounds: 0, 1",
+        "",
+    ]
+
+    # The remaining LEDs are split evenly among the animated sections
+    numSections = min(numSections, chainCount - 1)
+    sectionNames = []
+    for i in range(numSections):
+        start = 1 + (chainCount - 1) * i // numSections
+        end = 1 + (chainCount - 1) * (i + 1) // numSections
+        sectionNames.append("s%d" % i)
+        lines += ["[section s%d]" % i, "bounds: %d, %d" % (start, end), ""]
+
+    lines += ["[state %s]" % ",".join(stateNames), "rgb: 0.2, 0.2, 0.2", ""]
+
+    for stateName, color in zip(stateNames, MARKER_COLORS):
+        lines += [
+            "[state %s marker]" % stateName,
+            "rgb: %s" % ", ".join(str(c) for c in color),
+            "",
+        ]
+
+    for i, sectionName in enumerate(sectionNames):
+        lines += [
+            "[state %s %s]" % (",".join(stateNames), sectionName),
+            "rgb: %s" % SECTION_COLORS[i % len(SECTION_COLORS)],
+            "secondary_rgb: 0, 0, 0.5",
+            "animation: %s" % anims[i % len(anims)],
+            "animation_interval: %.2f" % (0.5 + 0.25 * (i % 4)),
+            "",
+        ]
+
+    return "\n".join(lines), stateNames
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def currentRssBytes():
+    try:
+        with open("/proc/self/statm", "r", encoding="utf-8") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def measureLatencies(pushes, shows, expectedPixels):
+    latencies = []
+    showIndex = 0
+    for pushTime, state in pushes:
+        while showIndex < len(shows) and shows[showIndex][0] < pushTime:
+            showIndex += 1
+
+        for showTime, pixel in shows[showIndex:]:
+            if pixel == expectedPixels[state]:
+                latencies.append(showTime - pushTime)
+                break
+
+    return latencies
+
+
+async def runCase(tmpDir, chainCount, numSections, animMix, args):
+    socketPath = os.path.join(tmpDir, "klippy.sock")
+    pushesPath = os.path.join(tmpDir, "pushes.json")
+    configPath = os.path.join(tmpDir, "status_led.cfg")
+
+    configStr, stateNames = makeConfig(
+        chainCount, numSections, ANIM_MIXES[animMix], args.source
+    )
+    with open(configPath, "w", encoding="utf-8") as file:
+        file.write(configStr)
+
+    config = StatusLEDConfig()
+    config.load(configPath)
+
+    output = MemoryOutput(3)
+    led = AnimatedLED(config, lambda outputType, options, count, bpp: output)
+    monitor = StatusMonitor(config, socketPath, led)
+
+    expectedPixels = {
+        stateName.split("_", 1)[1]: encodePixel(
+            [int(c * 255) for c in color], led.chains[0].frame.offsets
+        )
+        for stateName, color in zip(stateNames, MARKER_COLORS)
+    }
+
+    klippy = subprocess.Popen(
+        [
+            sys.executable,
+            FAKE_KLIPPY_PATH,
+            "--socket",
+            socketPath,
+            "--rate",
+            str(args.rate),
+            "--duration",
+            str(args.duration),
+            "--source",
+            args.source,
+            "--states",
+            ",".join(STATE_NAMES[args.source]),
+            "--pushes",
+            pushesPath,
+        ]
+    )
+
+    loop = asyncio.get_running_loop()
+    monitorTask = asyncio.create_task(monitor.run())
+
+    # Only measure once the monitor is connected and showing states
+    while not monitor.isConnected:
+        await asyncio.sleep(0.01)
+    await asyncio.sleep(0.1)
+
+    numShowsStart = len(output.shows)
+    cpuStart = time.process_time()
+    wallStart = time.monotonic()
+
+    await loop.run_in_executor(None, klippy.wait)
+
+    cpuTime = time.process_time() - cpuStart
+    wallTime = time.monotonic() - wallStart
+    numFrames = len(output.shows) - numShowsStart
+    rss = currentRssBytes()
+
+    monitorTask.cancel()
+    try:
+        await monitorTask
+    except asyncio.CancelledError:
+        pass
+    monitor.socketWatcher.stop()
+    if monitor.sock:
+        monitor.sock.close()
+    led.close()
+
+    with open(pushesPath, "r", encoding="utf-8") as file:
+        pushes = json.load(file)
+
+    latencies = measureLatencies(pushes["pushes"], output.shows, expectedPixels)
+
+    return {
+        "chains": chainCount,
+        "sections": numSections,
+        "anims": animMix,
+        "changes": len(pushes["pushes"]),
+        "missed": len(pushes["pushes"]) - len(latencies),
+        "latency_p50_ms": (percentile(latencies, 0.5) or 0) * 1000,
+        "latency_p90_ms": (percentile(latencies, 0.9) or 0) * 1000,
+        "latency_p99_ms": (percentile(latencies, 0.99) or 0) * 1000,
+        "fps": numFrames / wallTime,
+        "cpu_percent": cpuTime / wallTime * 100,
+        "cpu_per_frame_us": cpuTime / numFrames * 1e6 if numFrames else 0,
+        "rss_mb": rss / 2**20,
+        "klippy_requests": pushes["requests"],
+    }
+
+
+def printResult(result):
+    print(
+        "%5d LEDs %3d sections %-7s | latency p50 %6.2f p90 %6.2f p99 %6.2f ms "
+        "| %6.1f fps | CPU %5.1f%% %7.1f us/frame | RSS %5.1f MB | missed %d"
+        % (
+            result["chains"],
+            result["sections"],
+            result["anims"],
+            result["latency_p50_ms"],
+            result["latency_p90_ms"],
+            result["latency_p99_ms"],
+            result["fps"],
+            result["cpu_percent"],
+            result["cpu_per_frame_us"],
+            result["rss_mb"],
+            result["missed"],
+        ),
+        flush=True,
+    )
+
+
+def compareResults(results, baselinePath):
+    with open(baselinePath, "r", encoding="utf-8") as file:
+        baseline = {
+            (r["chains"], r["sections"], r["anims"]): r for r in json.load(file)
+        }
+
+    regressions = 0
+    for result in results:
+        previous = baseline.get((result["chains"], result["sections"], result["anims"]))
+        if not previous:
+            continue
+
+        for metric in ("latency_p50_ms", "cpu_percent", "cpu_per_frame_us"):
+            if result[metric] > previous[metric] * (1 + REGRESSION_TOLERANCE) + 0.01:
+                regressions += 1
+                print(
+                    "REGRESSION %d LEDs %d sections %s: %s %.2f -> %.2f"
+                    % (
+                        result["chains"],
+                        result["sections"],
+                        result["anims"],
+                        metric,
+                        previous[metric],
+                        result[metric],
+                    )
+                )
+
+    return regressions
+
+
+async def runAll(args):
+    results = []
+    with tempfile.TemporaryDirectory(prefix="ksl-bench-") as tmpDir:
+        for chainCount in [int(c) for c in args.chains.split(",")]:
+            for numSections in [int(s) for s in args.sections.split(",")]:
+                for animMix in args.anims.split(","):
+                    result = await runCase(
+                        tmpDir, chainCount, numSections, animMix, args
+                    )
+                    printResult(result)
+                    results.append(result)
+
+    return results
+
+
+def main():
+    args = argParser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    results = asyncio.run(runAll(args))
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as file:
+            json.dump(results, file, indent=2)
+
+    if args.compare and compareResults(results, args.compare):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
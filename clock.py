@@ -0,0 +1,78 @@
+# pylint: disable=C0103
+
+import os
+import time
+import logging
+import asyncio
+
+from klippy import LatencyHistogram
+
+# Upper bounds of the histogram of how late frames start
+JITTER_BUCKETS_S = (0.0001, 0.00025, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05)
+
+
+# Frame timing on the monotonic clock, which does not jump when NTP sets
+# the wall clock. Animation phases are derived from it as well.
+class FrameClock:
+    def __init__(self, frameInterval, lateThreshold):
+        self.frameInterval = frameInterval
+        self.lateThreshold = lateThreshold
+
+        self.jitter = LatencyHistogram(JITTER_BUCKETS_S)
+        self.numLateFrames = 0
+        self.numSkippedFrames = 0
+
+    def now(self):
+        return time.monotonic_ns() * 1e-9
+
+    # Waits until the deadline or until the event is set.
+    # Returns True if the deadline was reached.
+    async def waitUntil(self, deadline, event):
+        try:
+            await asyncio.wait_for(
+                event.wait(),
+                None if deadline is None else max(0, deadline - self.now()),
+            )
+            return False
+        except asyncio.TimeoutError:
+            pass
+
+        lateness = max(0.0, self.now() - deadline)
+        self.jitter.observe(lateness)
+
+        # Late frames are not caught up on. The frame of the current time is
+        # rendered next and the ones in between are skipped.
+        if lateness > self.lateThreshold:
+            self.numLateFrames += 1
+            self.numSkippedFrames += int(lateness / self.frameInterval)
+
+        return True
+
+
+# Seconds since a process was started, including the interpreter startup
+# and imports which a timestamp taken in Python would miss. None if /proc
+# is not available.
+def getProcessUptime(pid):
+    try:
+        with open("/proc/%d/stat" % pid, encoding="utf-8") as f:
+            # Fields after the name, which may contain spaces and parentheses
+            fields = f.read().rsplit(")", 1)[1].split()
+        startTime = int(fields[19]) / os.sysconf("SC_CLK_TCK")
+        return time.clock_gettime(time.CLOCK_BOOTTIME) - startTime
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+# Both only affect the calling thread and the threads it starts afterwards
+def setRealtimePriority(priority):
+    try:
+        os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(priority))
+    except (OSError, AttributeError) as e:
+        logging.warning("Unable to set real-time priority %d: %s", priority, e)
+
+
+def setCpuAffinity(cpus):
+    try:
+        os.sched_setaffinity(0, cpus)
+    except (OSError, AttributeError) as e:
+        logging.warning("Unable to set CPU affinity to %s: %s", cpus, e)
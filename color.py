@@ -0,0 +1,65 @@
+# pylint: disable=C0103
+
+# Output color correction. Frame buffers hold linear 8 bit values,
+# which are mapped through lookup tables with bytes.translate on show.
+
+# Extra bits of the corrected values, shown by temporal dithering
+DITHER_BITS = 4
+DITHER_STEPS = 1 << DITHER_BITS
+# Order of the dither offsets, which spreads them evenly over the cycle
+DITHER_SEQUENCE = tuple(
+    int(format(i, "0%db" % DITHER_BITS)[::-1], 2) for i in range(DITHER_STEPS)
+)
+
+
+class ColorCorrection:
+    def __init__(self, gamma=1.0, maxBrightness=1.0, dither=False):
+        self.isIdentity = gamma == 1.0 and maxBrightness >= 1.0 and not dither
+
+        # Corrected value of each input byte with DITHER_BITS more precision
+        maxValue = 255 << DITHER_BITS
+        precise = [
+            round(maxValue * (value / 255) ** gamma * min(maxBrightness, 1.0))
+            for value in range(256)
+        ]
+
+        if dither:
+            # One table per dither offset. Averaged over a cycle,
+            # the shown value is the precise one.
+            self.tables = [
+                bytes(min(255, (value + offset) >> DITHER_BITS) for value in precise)
+                for offset in DITHER_SEQUENCE
+            ]
+            # Bytes of which all tables agree, frames only containing
+            # these do not need to be dithered
+            self.stableValues = bytes(
+                value
+                for value in range(256)
+                if len({table[value] for table in self.tables}) == 1
+            )
+        else:
+            self.tables = [
+                bytes(
+                    min(255, (value + DITHER_STEPS // 2) >> DITHER_BITS)
+                    for value in precise
+                )
+            ]
+            self.stableValues = bytes(range(256))
+
+        self.phase = 0
+
+    # Returns the corrected frame, advancing the dither cycle. It is written
+    # into out, so that the output is always passed the same buffer. Blinka
+    # reinitializes its DMA driver whenever it gets another buffer object.
+    def apply(self, buf, out):
+        if self.isIdentity:
+            return buf
+
+        table = self.tables[self.phase]
+        self.phase = (self.phase + 1) % len(self.tables)
+        out[:] = buf.translate(table)
+        return out
+
+    def needsDithering(self, buf):
+        # Deleting all stable values leaves the ones which flicker
+        return len(self.tables) > 1 and bool(buf.translate(None, self.stableValues))
@@ -6,15 +6,40 @@ import configparser
 
 from log import log
 from led import LEDState
+from effects import VALUE_EFFECTS
+from output import OUTPUT_TYPES
+from output import PIN_OUTPUT_TYPES
+from output import PWM_OUTPUT_TYPES
+
+# "unresponsive" is not reported by Klipper but set when requests time out
+KLIPPER_STATES = ("ready", "startup", "error", "shutdown", "unresponsive")
+PRINT_STATES = ("standby", "printing", "paused", "cancelled", "error", "complete")
+
+KNOWN_STATES = (
+    ("unknown",)
+    + tuple("klipper_" + state for state in KLIPPER_STATES)
+    + tuple("print_" + state for state in PRINT_STATES)
+)
 
 
 class StatusLEDConfig(configparser.ConfigParser):
     def __init__(self):
         super().__init__()
 
+        self.parsedPrinters = None
+        self.parsedOutputs = None
         self.parsedStates = None
         self.parsedSections = None
 
+        # Klipper object fields shown by value effects, as "object.field"
+        # and as the objects to subscribe to
+        self.valueRefs = None
+        self.valueObjects = None
+
+        self.configuredStates = None
+        self.statePlans = None
+        self.fallbackPlans = None
+
     def load(self, path):
         configFileContents = ""
         try:
@@ -33,9 +58,8 @@ class StatusLEDConfig(configparser.ConfigParser):
         # Parse configuration
         self.read_string(configFileContents)
 
-        if not "pin" in self["status_led"]:
-            logging.error("Missing pin definition. Check config.")
-            raise InvalidConfigException()
+        self.parsePrinters()
+        self.parseOutputs()
 
         self.parsedStates = [
             {"config": self[section]}
@@ -61,6 +85,8 @@ class StatusLEDConfig(configparser.ConfigParser):
                 logging.error("Missing state color. Check config.")
                 raise InvalidConfigException()
 
+            self.parseStateValue(state)
+
             logging.info("Parsed state: '%s'", state["config"].name)
 
         self.parsedSections = [
@@ -78,15 +104,257 @@ class StatusLEDConfig(configparser.ConfigParser):
 
             section["sectionName"] = nameSplit[1]
 
+            section["output"] = section["config"].get(
+                "output", fallback=self.parsedOutputs[0]["name"]
+            )
+            output = self.findByName(self.parsedOutputs, section["output"])
+            if not output:
+                logging.error(
+                    "Unknown output '%s' in section '%s'. Check config.",
+                    section["output"],
+                    section["sectionName"],
+                )
+                raise InvalidConfigException()
+
+            # Sections follow the printer of their output unless set
+            section["printer"] = section["config"].get(
+                "printer", fallback=output["printer"]
+            )
+            self.checkPrinter(section["printer"])
+
             logging.info("Parsed section: '%s'", section["config"].name)
 
-    def getLEDStateBySection(self, currentState):
-        logging.info("Loading state config of '%s'", currentState)
+        self.valueRefs = set()
+        for state in self.parsedStates:
+            for ref in (state["value"], state["valueMin"], state["valueMax"]):
+                if isinstance(ref, str):
+                    self.valueRefs.add(ref)
+
+        self.valueObjects = {}
+        for ref in sorted(self.valueRefs):
+            objectName, field = ref.rsplit(".", 1)
+            self.valueObjects.setdefault(objectName, []).append(field)
+
+        self.compileStatePlans()
+
+    def parseStateValue(self, state):
+        state["value"] = None
+        state["valueMin"] = 0.0
+        state["valueMax"] = 1.0
+
+        if state["config"].get("animation") not in VALUE_EFFECTS:
+            return
+
+        if not "value" in state["config"]:
+            logging.error(
+                "Missing value of state '%s'. Check config.", state["config"].name
+            )
+            raise InvalidConfigException()
+
+        state["value"] = StatusLEDConfig.strToValueRef(state["config"].get("value"))
+        state["valueMin"] = StatusLEDConfig.strToValueRef(
+            state["config"].get("value_min", fallback="0")
+        )
+        state["valueMax"] = StatusLEDConfig.strToValueRef(
+            state["config"].get("value_max", fallback="1")
+        )
+
+        if not isinstance(state["value"], str):
+            logging.error(
+                "Value of state '%s' must be an object field, e.g. "
+                "display_status.progress. Check config.",
+                state["config"].name,
+            )
+            raise InvalidConfigException()
+
+    def parsePrinters(self):
+        self.parsedPrinters = []
+
+        printerSections = [
+            section for section in self.sections() if section.split(" ")[0] == "printer"
+        ]
+
+        # [status_led] itself defines the "default" printer, unless only
+        # [printer ...] sections are used
+        statusLed = self["status_led"]
+        if not printerSections or "klippy_uds_path" in statusLed:
+            self.parsedPrinters.append({"name": "default", "config": statusLed})
+
+        for section in printerSections:
+            nameSplit = section.split(" ")
+
+            if len(nameSplit) <= 1:
+                logging.error("Missing printer name. Check config.")
+                raise InvalidConfigException()
+
+            if not "klippy_uds_path" in self[section]:
+                logging.error(
+                    "Missing klippy_uds_path of printer '%s'. Check config.",
+                    nameSplit[1],
+                )
+                raise InvalidConfigException()
+
+            self.parsedPrinters.append({"name": nameSplit[1], "config": self[section]})
+
+        for printer in self.parsedPrinters:
+            logging.info("Parsed printer: '%s'", printer["name"])
+
+    def checkPrinter(self, printerName):
+        if not self.findByName(self.parsedPrinters, printerName):
+            logging.error("Unknown printer '%s'. Check config.", printerName)
+            raise InvalidConfigException()
+
+    @staticmethod
+    def findByName(parsed, name):
+        return next((entry for entry in parsed if entry["name"] == name), None)
+
+    def parseOutputs(self):
+        self.parsedOutputs = []
 
+        outputSections = [
+            section for section in self.sections() if section.split(" ")[0] == "output"
+        ]
+
+        # [status_led] itself defines the "default" output, unless only
+        # [output ...] sections are used
+        statusLed = self["status_led"]
+        if not outputSections or "pin" in statusLed or "output" in statusLed:
+            self.parsedOutputs.append(
+                {
+                    "name": "default",
+                    "config": statusLed,
+                    "type": statusLed.get("output", "neopixel"),
+                }
+            )
+
+        for section in outputSections:
+            nameSplit = section.split(" ")
+
+            if len(nameSplit) <= 1:
+                logging.error("Missing output name. Check config.")
+                raise InvalidConfigException()
+
+            self.parsedOutputs.append(
+                {
+                    "name": nameSplit[1],
+                    "config": self[section],
+                    "type": self[section].get("type", "neopixel"),
+                }
+            )
+
+        # The PWM outputs would reset each other's PWM and DMA setup
+        pwmOutputs = [
+            output["name"]
+            for output in self.parsedOutputs
+            if output["type"] in PWM_OUTPUT_TYPES
+        ]
+        if len(pwmOutputs) > 1:
+            logging.error(
+                "Only one output may be of type 'neopixel' or 'ws281x', found %s. "
+                "Use type 'spi' for further chains. Check config.",
+                ", ".join("'%s'" % name for name in pwmOutputs),
+            )
+            raise InvalidConfigException()
+
+        for output in self.parsedOutputs:
+            if output["type"] not in OUTPUT_TYPES:
+                logging.error("Unknown output '%s'. Check config.", output["type"])
+                raise InvalidConfigException()
+
+            if output["type"] in PIN_OUTPUT_TYPES and not "pin" in output["config"]:
+                logging.error("Missing pin definition. Check config.")
+                raise InvalidConfigException()
+
+            output["printer"] = output["config"].get(
+                "printer", fallback=self.parsedPrinters[0]["name"]
+            )
+            self.checkPrinter(output["printer"])
+
+            logging.info("Parsed output: '%s' (%s)", output["name"], output["type"])
+
+    def compileStatePlans(self):
+        self.configuredStates = set()
+        for state in self.parsedStates:
+            self.configuredStates.update(state["stateNameList"])
+        stateNames = self.configuredStates.union(KNOWN_STATES)
+
+        # Each printer has its own plans for the sections it drives.
+        # A plan holds one LEDState per section, the default section first.
+        self.statePlans = {}
+        self.fallbackPlans = {}
+        for printer in self.parsedPrinters:
+            printerName = printer["name"]
+            self.statePlans[printerName] = {
+                stateName: self.resolveLEDStates(stateName, printerName)
+                for stateName in stateNames
+            }
+
+            # All sections fall back for states which are not configured
+            self.fallbackPlans[printerName] = self.resolveLEDStates(None, printerName)
+
+            for stateName in sorted(self.statePlans[printerName]):
+                for ledState in self.statePlans[printerName][stateName]:
+                    logging.debug("%s '%s': %s", printerName, stateName, ledState)
+
+    def isStateConfigured(self, stateName):
+        return stateName in self.configuredStates
+
+    def getLEDStateBySection(
+        self, currentState, printerName="default", sectionStates=None
+    ):
+        logging.debug("Loading state config of '%s' for '%s'", currentState, printerName)
+
+        plan = self.statePlans[printerName].get(
+            currentState, self.fallbackPlans[printerName]
+        )
+        if not sectionStates:
+            return plan
+
+        # Overridden sections show their part of the plan of another state
+        overrides = {}
+        for sectionName, sectionState in sectionStates.items():
+            logging.debug(
+                "Loading state config of '%s' for section '%s' of '%s'",
+                sectionState,
+                sectionName,
+                printerName,
+            )
+            overrides[sectionName] = [
+                state
+                for state in self.statePlans[printerName].get(
+                    sectionState, self.fallbackPlans[printerName]
+                )
+                if state.sectionName == sectionName
+            ]
+
+        states = []
+        for state in plan:
+            if state.sectionName not in overrides:
+                states.append(state)
+            elif overrides[state.sectionName] is not None:
+                # The default section has one state per output
+                states.extend(overrides[state.sectionName])
+                overrides[state.sectionName] = None
+
+        return tuple(states)
+
+    def getSectionNames(self, printerName="default"):
+        return ["default"] + [
+            section["sectionName"]
+            for section in self.parsedSections
+            if section["printer"] == printerName
+        ]
+
+    def resolveLEDStates(self, currentState, printerName="default"):
         states = []
 
-        # The default section which includes all LEDs is an empty dict
-        for section in [{}] + self.parsedSections:
+        # The default section which includes all LEDs
+        # of the printer's outputs is an empty dict
+        for section in [{}] + [
+            section
+            for section in self.parsedSections
+            if section["printer"] == printerName
+        ]:
             stateOfThisSection = None
             for state in self.parsedStates:
                 if (
@@ -105,60 +373,112 @@ class StatusLEDConfig(configparser.ConfigParser):
                     if "sectionNameList" in state:
                         break
 
-            if stateOfThisSection:
-                states.append(
-                    LEDState(
-                        (
-                            StatusLEDConfig.strToIntTuple(
-                                section["config"].get("bounds")
-                            )
-                            if section
-                            else (0, None)
-                        ),
-                        StatusLEDConfig.strToColor(
-                            stateOfThisSection["config"].get("rgb")
-                        ),
-                        StatusLEDConfig.strToColor(
-                            stateOfThisSection["config"].get(
-                                "secondary_rgb", fallback="0, 0, 0"
-                            )
-                        ),
-                        stateOfThisSection["config"].get("animation", fallback="solid"),
-                        float(
+            sectionName = (
+                section["sectionName"]
+                if section and "sectionName" in section
+                else "default"
+            )
+
+            outputNames = (
+                [section["output"]]
+                if section
+                else [
+                    output["name"]
+                    for output in self.parsedOutputs
+                    if output["printer"] == printerName
+                ]
+            )
+
+            for outputName in outputNames:
+                if stateOfThisSection:
+                    states.append(
+                        LEDState(
+                            (
+                                StatusLEDConfig.getSectionBounds(section)
+                                if section
+                                else (0, None)
+                            ),
+                            StatusLEDConfig.strToColor(
+                                stateOfThisSection["config"].get("rgb")
+                            ),
+                            StatusLEDConfig.strToColor(
+                                stateOfThisSection["config"].get(
+                                    "secondary_rgb", fallback="0, 0, 0"
+                                )
+                            ),
                             stateOfThisSection["config"].get(
-                                "animation_interval", fallback=1
-                            )
-                        ),
-                        (
-                            section["sectionName"]
-                            if section and "sectionName" in section
-                            else "default"
-                        ),
-                    )
-                )
-            else:
-                fallbackBounds = (0, None)
-                fallbackColor = (0, 0, 0)
-                if "fallback_rgb" in self["status_led"]:
-                    fallbackColor = StatusLEDConfig.strToColor(
-                        self.get("status_led", "fallback_rgb")
-                    )
-                if section:
-                    if "fallback_rgb" in section["config"]:
-                        fallbackBounds = StatusLEDConfig.strToIntTuple(
-                            section["config"].get("bounds")
+                                "animation", fallback="solid"
+                            ),
+                            float(
+                                stateOfThisSection["config"].get(
+                                    "animation_interval", fallback=1
+                                )
+                            ),
+                            sectionName,
+                            outputName,
+                            stateOfThisSection["config"].getint(
+                                "animation_length", fallback=None
+                            ),
+                            printerName,
+                            stateOfThisSection["value"],
+                            stateOfThisSection["valueMin"],
+                            stateOfThisSection["valueMax"],
                         )
+                    )
+                else:
+                    # Fallbacks stay within the section, so that
+                    # other printers' sections on the chain are kept
+                    fallbackColor = (0, 0, 0)
+                    if "fallback_rgb" in self["status_led"]:
                         fallbackColor = StatusLEDConfig.strToColor(
-                            section["config"].get("fallback_rgb")
+                            self.get("status_led", "fallback_rgb")
                         )
-                states.append(LEDState(fallbackBounds, fallbackColor))
+                    if section:
+                        if "fallback_rgb" in section["config"]:
+                            fallbackColor = StatusLEDConfig.strToColor(
+                                section["config"].get("fallback_rgb")
+                            )
+                    states.append(
+                        LEDState(
+                            (
+                                StatusLEDConfig.getSectionBounds(section)
+                                if section
+                                else (0, None)
+                            ),
+                            fallbackColor,
+                            sectionName=sectionName,
+                            output=outputName,
+                            printer=printerName,
+                        )
+                    )
 
-        return states
+        return tuple(states)
+
+    @staticmethod
+    def getSectionBounds(section):
+        # Sections without bounds span their whole output
+        if "bounds" not in section["config"]:
+            return (0, None)
+        return StatusLEDConfig.strToIntTuple(section["config"].get("bounds"))
 
     @staticmethod
     def strToColor(colStr):
         return tuple([int(float(val) * 255) for val in colStr.strip().split(",")])
 
+    # Numbers are constants, anything else an "object.field" reference
+    @staticmethod
+    def strToValueRef(valueStr):
+        valueStr = valueStr.strip()
+        try:
+            return float(valueStr)
+        except ValueError:
+            pass
+
+        if "." not in valueStr:
+            logging.error("Invalid value '%s'. Check config.", valueStr)
+            raise InvalidConfigException()
+        return valueStr
+
     @staticmethod
     def strToIntTuple(tupleStr):
         return tuple([int(val) for val in tupleStr.strip().split(",")])
@@ -0,0 +1,79 @@
+# pylint: disable=C0103
+
+import os
+import json
+import logging
+import asyncio
+
+
+# Local control API on a Unix socket, independent of klippy's G-code queue.
+# Each line is a JSON object with the parameters of the set_status_led
+# remote method and optionally the "printer" it is meant for, e.g.
+#   {"printer": "default", "state": "heating", "sections": {"logo": "busy"}}
+# Every line is answered with {"state": "<shown state>"} or {"error": "..."}
+# and any "id" of the request.
+class ControlServer:
+    def __init__(self, path, monitors):
+        self.path = path
+        self.monitors = {monitor.printerName: monitor for monitor in monitors}
+        self.defaultPrinter = monitors[0].printerName
+        self.server = None
+
+    async def start(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.server = await asyncio.start_unix_server(self.handleClient, self.path)
+
+        logging.info("Listening for control commands on '%s'", self.path)
+
+    def close(self):
+        if self.server:
+            self.server.close()
+
+    async def handleClient(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if not line.strip():
+                    continue
+
+                writer.write(json.dumps(self.handleCommand(line)).encode() + b"\n")
+                await writer.drain()
+        except (ValueError, asyncio.LimitOverrunError, OSError) as e:
+            logging.debug("Control client disconnected: %s", e)
+        finally:
+            writer.close()
+
+    def handleCommand(self, line):
+        try:
+            line = line.decode()
+            params = json.loads(line)
+        except ValueError:
+            return {"error": "Invalid JSON"}
+        if not isinstance(params, dict):
+            return {"error": "Expected an object"}
+
+        response = {"id": params["id"]} if "id" in params else {}
+
+        printerName = params.get("printer", self.defaultPrinter)
+        monitor = self.monitors.get(printerName)
+        if monitor is None:
+            response["error"] = "Unknown printer '%s'" % printerName
+            return response
+
+        # Nothing is applied unless all of the command is valid
+        updates, errors = monitor.checkRemoteParams(params)
+        if errors:
+            logging.warning(
+                "Invalid control command '%s': %s", line.strip(), "; ".join(errors)
+            )
+            response["error"] = "Invalid parameters: %s" % "; ".join(errors)
+            return response
+
+        if monitor.applyRemoteUpdates(updates):
+            monitor.updateLEDState()
+
+        response["state"] = monitor.currentState
+        return response
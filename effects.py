@@ -0,0 +1,185 @@
+# pylint: disable=C0103
+
+import math
+import random
+import colorsys
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Per-pixel effects. Rows are rendered once per period by led.buildKeyframes
+# and cached, so animating a section only copies a precomputed row per frame.
+
+# Default spacing of lit LEDs in a chase
+CHASE_SPACING = 4
+# Default comet tail as a fraction of the section
+COMET_TAIL_FRACTION = 0.25
+# Higher values make twinkles shorter
+TWINKLE_SHARPNESS = 8
+# Twinkle phases are stored as bytes
+TWINKLE_MAX_FRAMES = 256
+
+# Pattern of one period as a function of the LED k of the period and
+# the tail length. Returns the (primary, secondary) weights like
+# led.ANIM_FUNCTIONS. The pattern moves towards higher k.
+PATTERN_FUNCTIONS = {
+    "chase": lambda k, period, tail: (1.0, 0.0) if k == 0 else (0.0, 1.0),
+    # The head is at k = 0, the tail fades out behind it
+    "comet": lambda k, period, tail: (
+        max(0.0, 1.0 - ((period - k) % period) / tail),
+        min(1.0, ((period - k) % period) / tail),
+    ),
+    "gradient": lambda k, period, tail: (
+        0.5 + 0.5 * math.cos(2 * math.pi * k / period),
+        0.5 - 0.5 * math.cos(2 * math.pi * k / period),
+    ),
+}
+
+MOVING_EFFECTS = tuple(PATTERN_FUNCTIONS) + ("rainbow",)
+EFFECTS = MOVING_EFFECTS + ("twinkle",)
+
+# Effects showing a live value instead of animating over time.
+# Their rows are indexed by the quantized value instead of the frame.
+VALUE_EFFECTS = ("progress", "ramp")
+# Number of distinct colors of a ramp
+RAMP_STEPS = 64
+
+
+def encodePixel(color, offsets):
+    pixel = bytearray(len(offsets))
+    for channel, offset in enumerate(offsets):
+        pixel[offset] = color[channel] if channel < len(color) else 0
+    return bytes(pixel)
+
+
+def mixColor(rgb, secondaryRgb, primary, secondary):
+    return [
+        min(255, int(prim * primary + sec * secondary))
+        for prim, sec in zip(rgb, secondaryRgb)
+    ]
+
+
+# The length sets the tail of a comet and the period of other patterns
+def patternPeriod(anim, animLength, sectionLen):
+    if anim == "comet" or not animLength:
+        return CHASE_SPACING if anim == "chase" else sectionLen
+    return animLength
+
+
+# One period of a moving pattern, as encoded pixels
+def buildPattern(anim, rgb, secondaryRgb, period, animLength, sectionLen, offsets):
+    if anim == "rainbow":
+        # The configured color only sets the brightness
+        value = max(rgb) / 255
+        return b"".join(
+            encodePixel(
+                [int(c * 255) for c in colorsys.hsv_to_rgb(k / period, 1.0, value)],
+                offsets,
+            )
+            for k in range(period)
+        )
+
+    tail = animLength or max(1, int(sectionLen * COMET_TAIL_FRACTION))
+    return b"".join(
+        encodePixel(
+            mixColor(rgb, secondaryRgb, *PATTERN_FUNCTIONS[anim](k, period, tail)),
+            offsets,
+        )
+        for k in range(period)
+    )
+
+
+# Frames of a pattern moving along the section by one period per interval.
+# Each frame is a slice of the pattern repeated over the section.
+def buildMovingRows(
+    anim, rgb, secondaryRgb, animLength, sectionLen, offsets, maxFrames
+):
+    bpp = len(offsets)
+    period = max(1, patternPeriod(anim, animLength, sectionLen))
+    pattern = buildPattern(
+        anim, rgb, secondaryRgb, period, animLength, sectionLen, offsets
+    )
+    tiled = pattern * (sectionLen // period + 2)
+
+    numFrames = max(1, min(period, maxFrames))
+    rows = []
+    for frame in range(numFrames):
+        start = (period - frame * period // numFrames) % period
+        rows.append(tiled[start * bpp : (start + sectionLen) * bpp])
+    return rows
+
+
+# Every LED fades in and out once per interval, each at a random phase
+def buildTwinkleRows(rgb, secondaryRgb, sectionLen, offsets, maxFrames):
+    numFrames = max(2, min(maxFrames, TWINKLE_MAX_FRAMES))
+
+    levels = []
+    for q in range(numFrames):
+        weight = math.sin(math.pi * q / numFrames) ** TWINKLE_SHARPNESS
+        levels.append(
+            encodePixel(mixColor(rgb, secondaryRgb, weight, 1.0 - weight), offsets)
+        )
+
+    # The same section always twinkles the same way
+    rng = random.Random(sectionLen)
+    phases = bytes(rng.randrange(numFrames) for _ in range(sectionLen))
+
+    if numpy:
+        levelArray = numpy.frombuffer(b"".join(levels), dtype=numpy.uint8).reshape(
+            numFrames, len(offsets)
+        )
+        indices = (
+            numpy.frombuffer(phases, dtype=numpy.uint8).astype(numpy.intp)[None, :]
+            + numpy.arange(numFrames)[:, None]
+        ) % numFrames
+        frames = levelArray[indices]
+        return [frames[frame].tobytes() for frame in range(numFrames)]
+
+    # Advance all phases of a frame at once with a byte translation table,
+    # then look up the pixel of each phase
+    rows = []
+    for frame in range(numFrames):
+        shift = bytes((v + frame) % numFrames for v in range(256))
+        rows.append(b"".join(map(levels.__getitem__, phases.translate(shift))))
+    return rows
+
+
+def buildEffectRows(
+    anim, rgb, secondaryRgb, animLength, sectionLen, offsets, maxFrames
+):
+    if sectionLen <= 0:
+        return [b""]
+
+    if anim == "twinkle":
+        return buildTwinkleRows(rgb, secondaryRgb, sectionLen, offsets, maxFrames)
+
+    return buildMovingRows(
+        anim, rgb, secondaryRgb, animLength, sectionLen, offsets, maxFrames
+    )
+
+
+# One row per level of the value, from the secondary to the primary color
+def buildValueRows(anim, rgb, secondaryRgb, sectionLen, offsets):
+    bpp = len(offsets)
+    primary = encodePixel(rgb, offsets)
+    secondary = encodePixel(secondaryRgb, offsets)
+
+    if anim == "progress":
+        # A bar of n LEDs is a slice of the filled section followed by the
+        # empty one, so the rows share one buffer
+        view = memoryview(primary * sectionLen + secondary * sectionLen)
+        return [
+            view[(sectionLen - n) * bpp : (2 * sectionLen - n) * bpp]
+            for n in range(sectionLen + 1)
+        ]
+
+    return [
+        encodePixel(
+            mixColor(rgb, secondaryRgb, step / RAMP_STEPS, 1.0 - step / RAMP_STEPS),
+            offsets,
+        )
+        * sectionLen
+        for step in range(RAMP_STEPS + 1)
+    ]
@@ -0,0 +1,83 @@
+# pylint: disable=C0103
+
+import os
+import mmap
+import struct
+import logging
+
+# Sequence number of the last complete frame, then the pixel count and
+# bytes per pixel of the section for the producer
+HEADER = struct.Struct("<QII")
+
+# Sections without new frames for this long show their configured state again
+DEFAULT_TIMEOUT_S = 1.0
+# Stale inputs are polled this often for a producer starting again
+STALE_POLL_INTERVAL_S = 0.1
+
+
+# Pixels of a section written by an external process into a shared file,
+# e.g. in /dev/shm. The file holds the header and two frame buffers in the
+# color order of the output. The producer writes frame n + 1 into buffer
+# (n + 1) % 2 and then sets the sequence to n + 1. The buffer of the current
+# sequence is only safe from being written while it is copied as long as the
+# producer publishes at most one frame per frame shown here, a faster one
+# may show a torn frame until the next poll.
+class FrameInput:
+    def __init__(self, path, count, bpp, timeout=DEFAULT_TIMEOUT_S):
+        self.path = path
+        self.count = count
+        self.bpp = bpp
+        self.timeout = timeout
+        self.frameSize = count * bpp
+
+        size = HEADER.size + 2 * self.frameSize
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o660)
+        try:
+            # A file of the right size is kept, a running producer
+            # may already be writing to it
+            if os.fstat(fd).st_size != size:
+                os.ftruncate(fd, size)
+            self.map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+
+        sequence = HEADER.unpack_from(self.map)[0]
+        HEADER.pack_into(self.map, 0, sequence, count, bpp)
+
+        self.view = memoryview(self.map)
+        self.lastSequence = sequence
+        self.lastChangeTime = None
+        self.isLive = False
+
+        logging.info("Reading frames of %d LEDs from '%s'", count, path)
+
+    def readSequence(self):
+        return HEADER.unpack_from(self.map)[0]
+
+    # Returns whether the shown frame changed, either because a new frame
+    # arrived or because the producer started or stopped
+    def poll(self, now):
+        sequence = self.readSequence()
+        if sequence != self.lastSequence:
+            self.lastSequence = sequence
+            self.lastChangeTime = now
+            if not self.isLive:
+                logging.info("Frames of '%s' are live", self.path)
+            self.isLive = True
+            return True
+
+        if self.isLive and now - self.lastChangeTime > self.timeout:
+            logging.info("Frames of '%s' are stale", self.path)
+            self.isLive = False
+            return True
+
+        return False
+
+    # View of the buffer of the current frame, valid until the next poll()
+    def frame(self):
+        begin = HEADER.size + (self.lastSequence % 2) * self.frameSize
+        return self.view[begin : begin + self.frameSize]
+
+    def close(self):
+        self.view.release()
+        self.map.close()
@@ -0,0 +1,384 @@
+# pylint: disable=C0103
+
+import os
+import json
+import time
+import bisect
+import errno
+import socket
+import struct
+import logging
+import asyncio
+import ctypes
+import ctypes.util
+
+RECONNECT_BACKOFF_MIN_S = 0.05
+RECONNECT_BACKOFF_MAX_S = 2.0
+# Used when inotify is unavailable, e.g. if the directory does not exist yet
+SOCKET_POLL_INTERVAL_S = 0.5
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+REQUEST_TIMEOUT_S = 5.0
+# Round-trip latency histogram bucket bounds
+LATENCY_BUCKETS_S = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+# Weight of a new sample in the smoothed round-trip time
+RTT_SMOOTHING = 0.125
+
+FRAMER_INITIAL_SIZE = 65536
+FRAMER_MIN_READ_SIZE = 4096
+MESSAGE_DELIMITER = b"\x03"
+
+IN_ATTRIB = 0x00000004
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+INOTIFY_EVENT_HEADER = struct.Struct("iIII")
+
+
+# orjson is used when installed. It also parses memoryviews without a copy.
+if orjson:
+    parseMessage = orjson.loads
+else:
+
+    def parseMessage(data):
+        return json.loads(bytes(data))
+
+
+class MessageFramer:
+    def __init__(self, markers=None, size=FRAMER_INITIAL_SIZE):
+        self.buf = bytearray(size)
+        # Unprocessed data is buf[start:end], buf[start:scanned] has no delimiter
+        self.start = 0
+        self.end = 0
+        self.scanned = 0
+
+        # Messages containing none of these are dropped before parsing
+        self.markers = markers
+
+    def reserve(self):
+        if len(self.buf) - self.end >= FRAMER_MIN_READ_SIZE:
+            return
+
+        # Move the incomplete message to the front, then grow if still too small
+        if self.start > 0:
+            pending = self.end - self.start
+            self.buf[:pending] = self.buf[self.start : self.end]
+            self.scanned -= self.start
+            self.start = 0
+            self.end = pending
+
+        if len(self.buf) - self.end < FRAMER_MIN_READ_SIZE:
+            self.buf.extend(bytes(len(self.buf)))
+
+    def recvAvailable(self, sock):
+        received = 0
+        while True:
+            self.reserve()
+            with memoryview(self.buf) as view:
+                try:
+                    n = sock.recv_into(view[self.end :])
+                except BlockingIOError:
+                    return received
+
+            if n == 0:
+                return received
+            self.end += n
+            received += n
+
+    # Waits for data, then drains everything that is available.
+    # Returns 0 when the socket was closed.
+    async def receive(self, loop, sock):
+        self.reserve()
+        with memoryview(self.buf) as view:
+            n = await loop.sock_recv_into(sock, view[self.end :])
+
+        if n == 0:
+            return 0
+        self.end += n
+
+        return n + self.recvAvailable(sock)
+
+    def isRelevant(self, start, end):
+        if not self.markers:
+            return True
+        return any(self.buf.find(marker, start, end) >= 0 for marker in self.markers)
+
+    # Calls handler with a memoryview of each complete message.
+    # The view is only valid during the call.
+    def dispatch(self, handler):
+        buf = self.buf
+        while True:
+            delimiter = buf.find(MESSAGE_DELIMITER, self.scanned, self.end)
+            if delimiter < 0:
+                self.scanned = self.end
+                break
+
+            start = self.start
+            self.start = self.scanned = delimiter + 1
+
+            if self.isRelevant(start, delimiter):
+                with memoryview(buf) as view:
+                    handler(view[start:delimiter])
+
+        if self.start == self.end:
+            self.start = self.end = self.scanned = 0
+
+    def reset(self):
+        self.start = self.end = self.scanned = 0
+
+
+class LatencyHistogram:
+    def __init__(self, buckets=LATENCY_BUCKETS_S):
+        self.buckets = buckets
+        # The last count is for samples above the highest bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    # Upper bucket bound below which the given fraction of samples lie
+    def quantile(self, q):
+        if not self.count:
+            return None
+
+        threshold = q * self.count
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            if cumulative >= threshold:
+                return bound
+        return float("inf")
+
+
+class PendingRequest:
+    __slots__ = ("method", "handler", "sentTime")
+
+    def __init__(self, method, handler, sentTime):
+        self.method = method
+        self.handler = handler
+        self.sentTime = sentTime
+
+
+class RequestManager:
+    def __init__(self, timeout=REQUEST_TIMEOUT_S):
+        self.timeout = timeout
+
+        self.nextId = 0
+        self.pending = {}
+
+        self.latency = LatencyHistogram()
+        self.smoothedRtt = None
+
+        # Set when a request timed out, cleared by the next response
+        self.isUnresponsive = False
+        self.numTimeouts = 0
+
+    def reset(self):
+        self.pending.clear()
+        self.isUnresponsive = False
+
+    # Returns the id and the encoded request, the handler is called with the response
+    def create(self, method, params, handler):
+        self.nextId += 1
+        requestId = "ksl-%d" % self.nextId
+
+        self.expect(requestId, method, handler)
+
+        return requestId, (
+            json.dumps({"id": requestId, "method": method, "params": params}).encode()
+            + MESSAGE_DELIMITER
+        )
+
+    # Waits for the response to a request sent elsewhere,
+    # e.g. by the process a replayed recording was taken of
+    def expect(self, requestId, method, handler):
+        self.pending[requestId] = PendingRequest(method, handler, time.monotonic())
+
+    def cancel(self, requestId):
+        self.pending.pop(requestId, None)
+
+    # Returns the handler of the request with this id, or None
+    def resolve(self, requestId):
+        self.isUnresponsive = False
+
+        request = self.pending.pop(requestId, None)
+        if request is None:
+            logging.debug("Response to unknown or timed out request '%s'", requestId)
+            return None
+
+        rtt = time.monotonic() - request.sentTime
+        self.latency.observe(rtt)
+        self.smoothedRtt = (
+            rtt
+            if self.smoothedRtt is None
+            else self.smoothedRtt + RTT_SMOOTHING * (rtt - self.smoothedRtt)
+        )
+
+        return request.handler
+
+    # Drops requests without a response. Returns True if any timed out.
+    def expire(self):
+        deadline = time.monotonic() - self.timeout
+        expired = [
+            requestId
+            for requestId, request in self.pending.items()
+            if request.sentTime < deadline
+        ]
+
+        for requestId in expired:
+            logging.warning(
+                "Request '%s' (%s) timed out.",
+                requestId,
+                self.pending.pop(requestId).method,
+            )
+
+        if expired:
+            self.numTimeouts += len(expired)
+            self.isUnresponsive = True
+
+        return bool(expired)
+
+    def isPending(self, method):
+        return any(request.method == method for request in self.pending.values())
+
+    def numInFlight(self):
+        return len(self.pending)
+
+
+def inotifyWatch(directory):
+    libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+
+    fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    if fd < 0:
+        raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+    if (
+        libc.inotify_add_watch(
+            fd, os.fsencode(directory), IN_CREATE | IN_MOVED_TO | IN_ATTRIB
+        )
+        < 0
+    ):
+        error = ctypes.get_errno()
+        os.close(fd)
+        raise OSError(error, os.strerror(error), directory)
+
+    return fd
+
+
+class SocketWatcher:
+    def __init__(self, path):
+        self.path = path
+        self.name = os.fsencode(os.path.basename(path))
+        self.fd = None
+        self.changed = None
+
+    def start(self):
+        self.changed = asyncio.Event()
+
+        directory = os.path.dirname(self.path) or "."
+        try:
+            self.fd = inotifyWatch(directory)
+            asyncio.get_running_loop().add_reader(self.fd, self.readEvents)
+        except (OSError, AttributeError) as e:
+            logging.info(
+                "Unable to watch '%s' (%s), polling for the socket instead.",
+                directory,
+                e,
+            )
+            self.fd = None
+
+    def stop(self):
+        if self.fd is not None:
+            asyncio.get_running_loop().remove_reader(self.fd)
+            os.close(self.fd)
+            self.fd = None
+
+    def readEvents(self):
+        try:
+            data = os.read(self.fd, 4096)
+        except BlockingIOError:
+            return
+
+        offset = 0
+        while offset + INOTIFY_EVENT_HEADER.size <= len(data):
+            _, _, _, nameLen = INOTIFY_EVENT_HEADER.unpack_from(data, offset)
+            offset += INOTIFY_EVENT_HEADER.size
+            name = data[offset : offset + nameLen].rstrip(b"\0")
+            offset += nameLen
+
+            if name == self.name:
+                self.changed.set()
+
+    def clear(self):
+        self.changed.clear()
+
+    # Waits until the socket file changed or the timeout expired
+    async def waitForChange(self, timeout=None):
+        if self.fd is None:
+            timeout = (
+                SOCKET_POLL_INTERVAL_S
+                if timeout is None
+                else min(timeout, SOCKET_POLL_INTERVAL_S)
+            )
+
+        try:
+            await asyncio.wait_for(self.changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def connectSocket(socketPath, watcher):
+    loop = asyncio.get_running_loop()
+    logging.info("Waiting for connection to '%s'", socketPath)
+
+    backoff = RECONNECT_BACKOFF_MIN_S
+    lastErrno = None
+
+    while True:
+        # Events arriving during the attempt make the next wait return at once
+        watcher.clear()
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.setblocking(False)
+
+        try:
+            await loop.sock_connect(sock, socketPath)
+            break
+        except OSError as e:
+            sock.close()
+
+            if e.errno != lastErrno:
+                lastErrno = e.errno
+
+                if e.errno == errno.ENOENT:
+                    logging.info(
+                        "Socket '%s' does not exist yet. Waiting for it to be created.",
+                        socketPath,
+                    )
+                elif e.errno != errno.ECONNREFUSED:
+                    logging.warning(
+                        "Unable to open socket at '%s' [%d, %s]",
+                        socketPath,
+                        e.errno,
+                        errno.errorcode.get(e.errno, "?"),
+                    )
+
+            if e.errno == errno.ENOENT:
+                # Retry as soon as Klipper creates the socket
+                await watcher.waitForChange()
+                backoff = RECONNECT_BACKOFF_MIN_S
+            else:
+                # Klipper is not accepting connections yet, e.g. during a restart.
+                # A recreated socket still cuts the wait short.
+                await watcher.waitForChange(backoff)
+                backoff = min(backoff * 2, RECONNECT_BACKOFF_MAX_S)
+
+    logging.info("Connected.")
+    return sock
@@ -3,45 +3,31 @@
 import os
 import logging
 import math
+import functools
 
-import board
-import neopixel
-
-import time, threading
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 
 from log import log
-
-# ugly pin lookup dictionary
-PIN_DICT = {
-    "D0": board.D0,
-    "D1": board.D1,
-    "D2": board.D2,
-    "D3": board.D3,
-    "D4": board.D4,
-    "D5": board.D5,
-    "D6": board.D6,
-    "D7": board.D7,
-    "D8": board.D8,
-    "D9": board.D9,
-    "D10": board.D10,
-    "D11": board.D11,
-    "D12": board.D12,
-    "D13": board.D13,
-    "D14": board.D14,
-    "D15": board.D15,
-    "D16": board.D16,
-    "D17": board.D17,
-    "D18": board.D18,
-    "D19": board.D19,
-    "D20": board.D20,
-    "D21": board.D21,
-    "D22": board.D22,
-    "D23": board.D23,
-    "D24": board.D24,
-    "D25": board.D25,
-    "D26": board.D26,
-    "D27": board.D27,
-}
+from klippy import LatencyHistogram
+from metrics import FRAME_TIME_BUCKETS_S
+from metrics import FrameStats
+from clock import FrameClock
+from clock import getProcessUptime
+from clock import setCpuAffinity
+from clock import setRealtimePriority
+from output import createOutput
+from color import ColorCorrection
+from effects import EFFECTS
+from effects import VALUE_EFFECTS
+from effects import encodePixel
+from effects import mixColor
+from effects import buildEffectRows
+from effects import buildValueRows
+from framebuffer import FrameInput
+from framebuffer import DEFAULT_TIMEOUT_S
+from framebuffer import STALE_POLL_INTERVAL_S
 
 ANIM_FUNCTIONS = {
     "solid": lambda t: (1.0, 0.0),
@@ -58,6 +44,13 @@ ANIM_FUNCTIONS = {
 }
 
 ANIMATE_STEP_S = 0.01
+# Wake up slightly after an edge so that the new value is visible
+ANIM_EDGE_DELAY_S = 0.001
+KEYFRAME_CACHE_SIZE = 32
+# Frames rendered later than this after their scheduled time count as late
+LATE_FRAME_THRESHOLD_S = ANIMATE_STEP_S
+# Values are interpolated over the time between samples, at most this long
+VALUE_INTERPOLATION_MAX_S = 1.0
 
 
 def periodic(t):
@@ -65,25 +58,226 @@ def periodic(t):
     return t - int(t)
 
 
+class Keyframes:
+    def __init__(self, rows, rowIndices):
+        # Distinct rendered sections and the row shown in each frame
+        self.rows = rows
+        self.rowIndices = rowIndices
+        self.numFrames = len(rowIndices)
+
+        # Number of frames until a different row is shown, None if never
+        self.framesToChange = [None] * self.numFrames
+        if len(rows) > 1:
+            nextChange = None
+            for i in reversed(range(2 * self.numFrames)):
+                index = i % self.numFrames
+                if rowIndices[(i + 1) % self.numFrames] != rowIndices[index]:
+                    nextChange = i + 1
+                if nextChange is not None and i < self.numFrames:
+                    self.framesToChange[index] = nextChange - i
+
+    def frameAt(self, t):
+        return min(int(periodic(t) * self.numFrames), self.numFrames - 1)
+
+
+# Renders one period of an animation at the frame rate.
+# Frames are stored in strip byte order and deduplicated after quantization.
+@functools.lru_cache(maxsize=KEYFRAME_CACHE_SIZE)
+def buildKeyframes(
+    rgb, secondaryRgb, anim, animInterval, sectionLen, offsets, animLength=None
+):
+    if anim in VALUE_EFFECTS:
+        rows = buildValueRows(anim, rgb, secondaryRgb, sectionLen, offsets)
+        return Keyframes(tuple(rows), tuple(range(len(rows))))
+
+    maxFrames = max(2, round(animInterval / ANIMATE_STEP_S))
+
+    rows = []
+    rowIndices = []
+    rowIndexByRow = {}
+
+    if anim in EFFECTS:
+        frameRows = buildEffectRows(
+            anim, rgb, secondaryRgb, animLength, sectionLen, offsets, maxFrames
+        )
+    else:
+        # All LEDs of the section have the same color,
+        # so one pixel per frame is rendered and repeated afterwards
+        numFrames = 1 if anim == "solid" else maxFrames
+        frameRows = [
+            encodePixel(
+                mixColor(rgb, secondaryRgb, *ANIM_FUNCTIONS[anim](frame / numFrames)),
+                offsets,
+            )
+            for frame in range(numFrames)
+        ]
+
+    for row in frameRows:
+        if row not in rowIndexByRow:
+            rowIndexByRow[row] = len(rows)
+            rows.append(row)
+        rowIndices.append(rowIndexByRow[row])
+
+    if anim not in EFFECTS:
+        rows = [pixel * sectionLen for pixel in rows]
+
+    return Keyframes(tuple(rows), tuple(rowIndices))
+
+
+# Live value of a Klipper object field, moving linearly from the
+# previous value to a new sample until the next one is expected
+class InterpolatedValue:
+    def __init__(self):
+        self.start = None
+        self.target = None
+        self.startTime = 0.0
+        self.duration = 0.0
+        self.lastSampleTime = None
+
+    def update(self, value, now):
+        if self.target is None:
+            self.start = value
+        else:
+            self.start = self.valueAt(now)
+            self.duration = min(now - self.lastSampleTime, VALUE_INTERPOLATION_MAX_S)
+
+        self.target = value
+        self.startTime = now
+        self.lastSampleTime = now
+
+    def isMoving(self, now):
+        return now < self.startTime + self.duration
+
+    def valueAt(self, now):
+        if not self.isMoving(now):
+            return self.target
+        return self.start + (self.target - self.start) * (
+            (now - self.startTime) / self.duration
+        )
+
+
+class FrameBuffer:
+    def __init__(self, count, bpp, pixelOrder):
+        self.count = count
+        self.bpp = bpp
+
+        # Byte offset of each of R, G, B (and W) within a pixel on the wire
+        self.offsets = tuple(pixelOrder.index(channel) for channel in "RGBW"[:bpp])
+
+        self.buf = bytearray(count * bpp)
+        self.view = memoryview(self.buf)
+
+    def blit(self, start, data):
+        begin = start * self.bpp
+        self.view[begin : begin + len(data)] = data
+
+
+class LEDChain:
+    def __init__(self, name, frame, output, correction):
+        self.name = name
+        self.frame = frame
+        self.output = output
+        self.correction = correction
+        # Corrected copy of the frame, reused on every show()
+        self.corrected = bytearray(len(frame.buf))
+        # Whether the frame has values between two output levels
+        self.isDithering = False
+
+    def updateDithering(self):
+        self.isDithering = self.correction.needsDithering(self.frame.buf)
+
+    def show(self):
+        self.output.show(self.correction.apply(self.frame.buf, self.corrected))
+
+
 class AnimatedLED:
-    def __init__(self, config):
+    def __init__(self, config, outputFactory=createOutput):
         self.config = config
 
-        self.enabled = True
+        # State changes are published as a new mapping of each printer's
+        # latest request and a new set of disabled printers. They are never
+        # modified once published, so the ticker always sees a consistent
+        # pair. The next render() applies them, so that any number of changes
+        # costs at most one rebuild per frame. Publishing copies and replaces
+        # them without a lock, so it must only happen on the event loop
+        # thread, like everything else touching the values and the ticker.
+        self.layerRequests = {}
+        self.disabledPrinters = frozenset()
+        self.lastForcedRenderTime = None
+
+        # Only used by render(): the requests it applied last, the resolved
+        # states of each printer and the FramePlan built from them
+        self.appliedLayerRequests = {}
+        self.appliedDisabledPrinters = self.disabledPrinters
+        self.layers = {}
+        self.plan = None
 
-        self.states = None
-        self.brightnesses = None
+        # InterpolatedValue by printer and "object.field"
+        self.values = {}
 
+        self.keyframeRows = None
+        self.hasShownFirstFrame = False
+        # Process whose startup the time to the first frame is measured from
+        self.servicePid = os.getpid()
+
+        # Wakes the animation ticker on state changes,
+        # created once the event loop is running
+        self.wakeEvent = None
+        self.forceUpdate = False
+
+        # Paces the ticker and drives all animation phases
+        self.clock = FrameClock(ANIMATE_STEP_S, LATE_FRAME_THRESHOLD_S)
+
+        # Metrics, updated on every frame
+        self.renderTime = LatencyHistogram(FRAME_TIME_BUCKETS_S)
+        self.showTime = LatencyHistogram(FRAME_TIME_BUCKETS_S)
+        self.numFrames = 0
+
+        self.chains = []
         try:
-            self.leds = neopixel.NeoPixel(
-                PIN_DICT[config.get("status_led", "pin")],
-                int(config.get("status_led", "chain_count", fallback="1")),
-                bpp=config.get("status_led", "bpp", fallback=3),
-                pixel_order=config.get("status_led", "color_order", fallback="GRB"),
-                auto_write=False,
-            )
-            self.leds.fill((0, 0, 0))
-            self.leds.show()
+            for outputConfig in config.parsedOutputs:
+                options = outputConfig["config"]
+                bpp = options.getint("bpp", fallback=3)
+                frame = FrameBuffer(
+                    options.getint("chain_count", fallback=1),
+                    bpp,
+                    options.get("color_order", fallback="GRB" if bpp == 3 else "GRBW"),
+                )
+
+                initStartTime = time.monotonic()
+                output = outputFactory(outputConfig["type"], options, frame.count, bpp)
+                logging.info(
+                    "Output '%s' initialized in %.3fs",
+                    outputConfig["name"],
+                    time.monotonic() - initStartTime,
+                )
+
+                # [output ...] sections use the [status_led] settings by default
+                correction = ColorCorrection(
+                    options.getfloat(
+                        "gamma",
+                        fallback=config.getfloat("status_led", "gamma", fallback=1.0),
+                    ),
+                    options.getfloat(
+                        "max_brightness",
+                        fallback=config.getfloat(
+                            "status_led", "max_brightness", fallback=1.0
+                        ),
+                    ),
+                    options.getboolean(
+                        "dither",
+                        fallback=config.getboolean(
+                            "status_led", "dither", fallback=False
+                        ),
+                    ),
+                )
+
+                self.chains.append(
+                    LEDChain(outputConfig["name"], frame, output, correction)
+                )
+
+            for chain in self.chains:
+                chain.show()
 
         except Exception as e:  # pylint: disable=W0718
             logging.exception(
@@ -92,68 +286,415 @@ class AnimatedLED:
             )
             log.flushAndExit(1)
 
-        timerThread = threading.Thread(target=self.run)
-        timerThread.start()
+        self.chainIndices = {chain.name: i for i, chain in enumerate(self.chains)}
 
-    def setEnabled(self, enabled):
-        if enabled != self.enabled:
-            self.enabled = enabled
+        # Sections showing the frames of an external producer while it is
+        # live, drawn over the states. Tuples of the printer, chain index,
+        # first LED and FrameInput.
+        self.frameInputs = []
+        try:
+            for section in config.parsedSections:
+                path = section["config"].get("framebuffer_path", fallback=None)
+                if not path:
+                    continue
 
-            if enabled:
-                self.write(True)
-            else:
-                self.leds.fill((0, 0, 0))
-                self.leds.show()
+                chainIndex = self.chainIndices[section["output"]]
+                frame = self.chains[chainIndex].frame
+                start, end = config.getSectionBounds(section)
+                start = min(start, frame.count)
+                end = frame.count if end is None else min(end, frame.count)
 
-    def updateState(self, states):
-        self.states = states
-        self.write(True)
+                self.frameInputs.append(
+                    (
+                        section["printer"],
+                        chainIndex,
+                        start,
+                        FrameInput(
+                            path,
+                            max(0, end - start),
+                            frame.bpp,
+                            section["config"].getfloat(
+                                "framebuffer_timeout", fallback=DEFAULT_TIMEOUT_S
+                            ),
+                        ),
+                    )
+                )
+        except OSError as e:
+            logging.error("Unable to open framebuffer: %s", e)
+            log.flushAndExit(1)
+
+        # Pinning applies to the whole process, including the output threads
+        cpuAffinity = config.get("status_led", "cpu_affinity", fallback=None)
+        if cpuAffinity:
+            setCpuAffinity(config.strToIntTuple(cpuAffinity))
+
+        # Writing to the strips blocks, so it is kept off the event loop.
+        # One worker per chain lets all chains be written in parallel.
+        # Only these threads get real-time priority, as they mostly wait
+        # for the hardware and cannot starve klippy.
+        realtimePriority = config.getint(
+            "status_led", "realtime_priority", fallback=None
+        )
+        self.outputExecutor = ThreadPoolExecutor(
+            max_workers=len(self.chains),
+            thread_name_prefix="led-output",
+            initializer=(
+                functools.partial(setRealtimePriority, realtimePriority)
+                if realtimePriority
+                else None
+            ),
+        )
+
+    async def show(self, chainIndices):
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(
+            *(
+                loop.run_in_executor(self.outputExecutor, self.chains[i].show)
+                for i in chainIndices
+            )
+        )
+
+    def close(self):
+        self.outputExecutor.shutdown()
+        for _, _, _, frameInput in self.frameInputs:
+            frameInput.close()
 
-    def write(self, forceUpdate):
-        if not self.states or not self.leds or not self.enabled:
+    def wake(self):
+        self.forceUpdate = True
+        if self.wakeEvent:
+            self.wakeEvent.set()
+
+    def setEnabled(self, enabled, printerName="default"):
+        if enabled == (printerName not in self.disabledPrinters):
+            return
+
+        if enabled:
+            self.disabledPrinters = self.disabledPrinters - {printerName}
+        else:
+            self.disabledPrinters = self.disabledPrinters | {printerName}
+        self.wake()
+
+    def getFrameStats(self):
+        return FrameStats(
+            self.renderTime,
+            self.showTime,
+            self.clock.jitter,
+            self.numFrames,
+            self.clock.numLateFrames,
+            self.clock.numSkippedFrames,
+        )
+
+    # Only the latest state of each printer is resolved by the next render
+    def setState(self, stateName, printerName="default", sectionStates=None):
+        self.publishLayer(printerName, (stateName, dict(sectionStates or {})))
+
+    def publishLayer(self, printerName, request):
+        layerRequests = dict(self.layerRequests)
+        layerRequests[printerName] = request
+        self.layerRequests = layerRequests
+        self.wake()
+
+    # Picks up the published requests, called by render() only
+    def applyPendingChanges(self):
+        layerRequests = self.layerRequests
+        disabledPrinters = self.disabledPrinters
+        if (
+            layerRequests is self.appliedLayerRequests
+            and disabledPrinters is self.appliedDisabledPrinters
+        ):
             return
 
-        brightnesses = []
+        for printerName, request in layerRequests.items():
+            if self.appliedLayerRequests.get(printerName) is request:
+                continue
 
-        for sectionState in self.states:
-            currentBrightness = ANIM_FUNCTIONS[sectionState.anim](
-                time.time() / sectionState.animInterval
+            stateName, sectionStates = request
+            self.layers[printerName] = self.config.getLEDStateBySection(
+                stateName, printerName, sectionStates
             )
-            brightnesses.append(currentBrightness)
 
-            sectionLen = (
-                (sectionState.bounds[1] - sectionState.bounds[0])
-                if sectionState.bounds[1] is not None
-                else len(self.leds)
+        self.appliedLayerRequests = layerRequests
+        self.appliedDisabledPrinters = disabledPrinters
+        self.plan = self.composeLayers(disabledPrinters)
+
+    def composeLayers(self, disabledPrinters):
+        states = []
+        for printerName, layerStates in self.layers.items():
+            if printerName in disabledPrinters:
+                # Sections of disabled printers are turned off
+                layerStates = [
+                    LEDState(
+                        state.bounds,
+                        sectionName=state.sectionName,
+                        output=state.output,
+                        printer=state.printer,
+                    )
+                    for state in layerStates
+                ]
+            states.extend(layerStates)
+
+        # Default sections of all printers are drawn first,
+        # so that no printer covers the sections of another one
+        states.sort(key=lambda state: state.sectionName != "default")
+
+        # Resolve chains and open section bounds once instead of on every frame
+        sectionRanges = []
+        for state in states:
+            chainIndex = self.chainIndices[state.output]
+            count = self.chains[chainIndex].frame.count
+            sectionRanges.append(
+                (
+                    chainIndex,
+                    min(state.bounds[0], count),
+                    (
+                        min(state.bounds[1], count)
+                        if state.bounds[1] is not None
+                        else count
+                    ),
+                )
             )
-            mixedColor = [
-                (prim * currentBrightness[0] + sec * currentBrightness[1])
-                for prim, sec in zip(sectionState.rgb, sectionState.secondaryRgb)
-            ]
-            self.leds[sectionState.bounds[0] : sectionState.bounds[1]] = [
-                mixedColor
-            ] * sectionLen
+
+        keyframes = [
+            buildKeyframes(
+                state.rgb,
+                state.secondaryRgb,
+                state.anim,
+                state.animInterval,
+                max(0, end - start),
+                self.chains[chainIndex].frame.offsets,
+                state.animLength,
+            )
+            for state, (chainIndex, start, end) in zip(states, sectionRanges)
+        ]
+
+        return FramePlan(states, sectionRanges, keyframes)
+
+    # Takes values from a status update. Only wakes the ticker,
+    # render() decides whether the shown levels changed.
+    def updateValues(self, status, printerName="default"):
+        now = self.clock.now()
+        hasChanged = False
+
+        for objectName, fields in status.items():
+            for field, value in fields.items():
+                ref = objectName + "." + field
+                if ref not in self.config.valueRefs:
+                    continue
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    continue
+
+                tracker = self.values.setdefault(
+                    (printerName, ref), InterpolatedValue()
+                )
+                if tracker.target != value:
+                    tracker.update(value, now)
+                    hasChanged = True
+
+        if hasChanged and self.wakeEvent:
+            self.wakeEvent.set()
+
+    # Returns the value of a reference or constant and whether it is moving
+    def getValue(self, printerName, ref, now):
+        if not isinstance(ref, str):
+            return ref, False
+
+        tracker = self.values.get((printerName, ref))
+        if tracker is None:
+            return 0.0, False
+        return tracker.valueAt(now), tracker.isMoving(now)
+
+    # Quantizes the value of a state to a row of its keyframes
+    def getValueLevel(self, state, numLevels, now):
+        value, isMoving = self.getValue(state.printer, state.value, now)
+        valueMin, _ = self.getValue(state.printer, state.valueMin, now)
+        valueMax, _ = self.getValue(state.printer, state.valueMax, now)
+
+        fraction = (
+            (value - valueMin) / (valueMax - valueMin) if valueMax != valueMin else 0.0
+        )
+        fraction = min(max(fraction, 0.0), 1.0)
+
+        return round(fraction * (numLevels - 1)), isMoving
+
+    # Renders the frame buffers if needed. Returns the time of the next
+    # visible change and the indices of the chains which need to be shown.
+    def render(self, forceUpdate):
+        self.applyPendingChanges()
+
+        plan = self.plan
+        if plan is None or not plan.states:
+            return None, ()
+        states = plan.states
+        sectionRanges = plan.sectionRanges
+        keyframes = plan.keyframes
+
+        now = self.clock.now()
+        keyframeRows = []
+        nextTime = None
+
+        for sectionState, sectionKeyframes in zip(states, keyframes):
+            if sectionState.value is not None:
+                level, isMoving = self.getValueLevel(
+                    sectionState, sectionKeyframes.numFrames, now
+                )
+                keyframeRows.append(level)
+
+                # Follow the interpolation at the frame rate
+                if isMoving and (nextTime is None or now + ANIMATE_STEP_S < nextTime):
+                    nextTime = now + ANIMATE_STEP_S
+                continue
+
+            t = now / sectionState.animInterval
+            frame = sectionKeyframes.frameAt(t)
+            keyframeRows.append(sectionKeyframes.rowIndices[frame])
+
+            framesToChange = sectionKeyframes.framesToChange[frame]
+            if framesToChange is not None:
+                sectionNextTime = (
+                    (math.floor(t * sectionKeyframes.numFrames) + framesToChange)
+                    / sectionKeyframes.numFrames
+                    * sectionState.animInterval
+                    + ANIM_EDGE_DELAY_S
+                )
+                # Sections with unaligned intervals would otherwise wake
+                # the ticker at their combined rate, above the frame rate
+                sectionNextTime = max(sectionNextTime, now + ANIMATE_STEP_S)
+                if nextTime is None or sectionNextTime < nextTime:
+                    nextTime = sectionNextTime
+
+        # Live producers are polled on every frame, stale ones less often.
+        # Chains with new external frames are shown, the ones of stopped
+        # producers redrawn.
+        inputChains = set()
+        staleChains = set()
+        if self.frameInputs:
+            pollInterval = STALE_POLL_INTERVAL_S
+            for _, chainIndex, _, frameInput in self.frameInputs:
+                if frameInput.poll(now):
+                    inputChains.add(chainIndex)
+                    if not frameInput.isLive:
+                        staleChains.add(chainIndex)
+                if frameInput.isLive:
+                    pollInterval = ANIMATE_STEP_S
+
+            if nextTime is None or now + pollInterval < nextTime:
+                nextTime = now + pollInterval
 
         # To avoid updating when the animation state is still the same,
-        # check whether brightnesses have changed
-        if (
-            not forceUpdate
-            and self.brightnesses is not None
-            and all([b[0] == b[1] for b in zip(brightnesses, self.brightnesses)])
+        # check whether the shown keyframes have changed
+        lastKeyframeRows = self.keyframeRows
+        if forceUpdate or lastKeyframeRows is None:
+            changedChains = set(range(len(self.chains)))
+        else:
+            changedChains = staleChains | {
+                chainIndex
+                for (chainIndex, _, _), row, lastRow in zip(
+                    sectionRanges, keyframeRows, lastKeyframeRows
+                )
+                if row != lastRow
+            }
+            if not changedChains and not inputChains:
+                return self.addDitherFrames(nextTime, changedChains, now)
+
+        self.keyframeRows = keyframeRows
+
+        # Sections are drawn in order, later ones cover earlier ones
+        for (chainIndex, start, _), sectionKeyframes, row in zip(
+            sectionRanges, keyframes, keyframeRows
         ):
-            return
+            if chainIndex in changedChains:
+                self.chains[chainIndex].frame.blit(start, sectionKeyframes.rows[row])
+
+        # External frames are copied straight from the shared buffer
+        for printerName, chainIndex, start, frameInput in self.frameInputs:
+            if (
+                frameInput.isLive
+                and printerName not in self.appliedDisabledPrinters
+                and (chainIndex in changedChains or chainIndex in inputChains)
+            ):
+                self.chains[chainIndex].frame.blit(start, frameInput.frame())
+        changedChains |= inputChains
 
-        self.brightnesses = brightnesses
+        for chainIndex in changedChains:
+            self.chains[chainIndex].updateDithering()
 
-        self.leds.show()
+        return self.addDitherFrames(nextTime, changedChains, now)
 
-    def run(self):
-        nextTime = time.time()
+    # Dithered chains are shown on every frame, even if nothing changed
+    def addDitherFrames(self, nextTime, changedChains, now):
+        ditheringChains = {
+            chainIndex
+            for chainIndex, chain in enumerate(self.chains)
+            if chain.isDithering
+        }
+        if not ditheringChains:
+            return nextTime, changedChains
+
+        if nextTime is None or now + ANIMATE_STEP_S < nextTime:
+            nextTime = now + ANIMATE_STEP_S
+        return nextTime, changedChains | ditheringChains
+
+    # State changes re-render at most once per frame, the ones
+    # arriving meanwhile are coalesced into the next render
+    def getForcedRenderTime(self, now):
+        if self.lastForcedRenderTime is None:
+            return now
+        return max(now, self.lastForcedRenderTime + ANIMATE_STEP_S)
+
+    # Renders the frame run() is woken for, also used by bench/replay.py
+    def renderNextFrame(self):
+        self.wakeEvent.clear()
+        forceUpdate = self.forceUpdate
+        self.forceUpdate = False
+        if forceUpdate:
+            self.lastForcedRenderTime = self.clock.now()
+
+        renderStartTime = time.perf_counter()
+        result = self.render(forceUpdate)
+        self.renderTime.observe(time.perf_counter() - renderStartTime)
+        return result
+
+    async def run(self):
+        self.wakeEvent = asyncio.Event()
+
+        nextTime = None
         while True:
-            self.write(False)
+            # Sleep until the next animation change or until woken
+            # by a state change. Without animations, this may be forever.
+            if not self.forceUpdate:
+                await self.clock.waitUntil(nextTime, self.wakeEvent)
+
+            if self.forceUpdate:
+                now = self.clock.now()
+                delay = self.getForcedRenderTime(now) - now
+                if delay > 0:
+                    await asyncio.sleep(delay)
 
-            nextTime = nextTime + ANIMATE_STEP_S
-            time.sleep(max(0, nextTime - time.time()))
+            nextTime, changedChains = self.renderNextFrame()
+
+            # The frame buffers are only touched again after show() returned
+            if changedChains:
+                showStartTime = time.perf_counter()
+                await self.show(changedChains)
+                self.showTime.observe(time.perf_counter() - showStartTime)
+                self.numFrames += 1
+
+                if not self.hasShownFirstFrame and self.plan:
+                    self.hasShownFirstFrame = True
+                    uptime = getProcessUptime(self.servicePid)
+                    if uptime is not None:
+                        logging.info("First frame shown %.3fs after startup", uptime)
+
+
+# Everything render() needs to draw the composed states. A plan is never
+# modified, applyPendingChanges() replaces it as a whole.
+class FramePlan:
+    __slots__ = ("states", "sectionRanges", "keyframes")
+
+    def __init__(self, states, sectionRanges, keyframes):
+        self.states = states
+        self.sectionRanges = sectionRanges
+        self.keyframes = keyframes
 
 
 class LEDState:
@@ -165,19 +706,36 @@ class LEDState:
         anim="solid",
         animInterval=1,
         sectionName="default",
+        output="default",
+        animLength=None,
+        printer="default",
+        value=None,
+        valueMin=0.0,
+        valueMax=1.0,
     ):
         self.bounds = bounds
         self.rgb = rgb
         self.secondaryRgb = secondaryRgb
         self.anim = anim
         self.animInterval = animInterval
+        self.sectionName = sectionName
+        self.output = output
+        # Spatial length of per-pixel effects in LEDs, None for the default
+        self.animLength = animLength
+        self.printer = printer
+        # "object.field" shown by value effects. The bounds are
+        # numbers or references as well.
+        self.value = value
+        self.valueMin = valueMin
+        self.valueMax = valueMax
 
-        logging.debug(
-            "Section ('%s' | %s) state: \t %s | %s | %s | %ss",
-            sectionName,
-            bounds,
-            rgb,
-            secondaryRgb,
-            anim,
-            animInterval,
+    def __repr__(self):
+        return "Section ('%s' | %s %s) state: \t %s | %s | %s | %ss" % (
+            self.sectionName,
+            self.output,
+            self.bounds,
+            self.rgb,
+            self.secondaryRgb,
+            self.anim,
+            self.animInterval,
         )
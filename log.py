@@ -12,14 +12,35 @@ from queue import SimpleQueue as Queue
 class Log:
     def __init__(self):
         self.queue = None
+        self.queueHandler = None
         self.listener = None
+        self.processListeners = []
 
     def initQueue(self, isVerbose):
         rootLogger = logging.getLogger()
 
         self.queue = Queue()
-        queueHandler = logging.handlers.QueueHandler(self.queue)
-        rootLogger.addHandler(queueHandler)
+        self.queueHandler = logging.handlers.QueueHandler(self.queue)
+        rootLogger.addHandler(self.queueHandler)
+        rootLogger.setLevel(logging.DEBUG if isVerbose else logging.INFO)
+
+    # Records of a child process are passed on to the queue of this one
+    def createProcessQueue(self, context):
+        processQueue = context.Queue()
+        listener = logging.handlers.QueueListener(processQueue, self.queueHandler)
+        listener.start()
+        self.processListeners.append(listener)
+        return processQueue
+
+    # Called in the child process with the queue from createProcessQueue()
+    def initProcessQueue(self, processQueue, isVerbose):
+        rootLogger = logging.getLogger()
+        for handler in list(rootLogger.handlers):
+            rootLogger.removeHandler(handler)
+
+        self.queue = processQueue
+        self.queueHandler = logging.handlers.QueueHandler(processQueue)
+        rootLogger.addHandler(self.queueHandler)
         rootLogger.setLevel(logging.DEBUG if isVerbose else logging.INFO)
 
     def start(self, logFilePath=None):
@@ -51,7 +72,15 @@ class Log:
         self.listener.start()
 
     def flush(self):
-        self.listener.stop()
+        for listener in self.processListeners:
+            listener.stop()
+        if self.listener:
+            self.listener.stop()
+
+        # A child process has to hand over its last records before exiting
+        if hasattr(self.queue, "join_thread"):
+            self.queue.close()
+            self.queue.join_thread()
 
     def flushAndExit(self, code):
         self.flush()
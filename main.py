@@ -4,22 +4,40 @@ import sys
 import os
 import argparse
 import logging
-import socket
-import time
-import errno
-import select
-import json
+import asyncio
 
 from log import log
 from config import StatusLEDConfig
 from config import InvalidConfigException
 from led import AnimatedLED
+from klippy import SocketWatcher
+from klippy import connectSocket
+from klippy import MessageFramer
+from klippy import parseMessage
+from klippy import RequestManager
+from metrics import MetricsServer
+from control import ControlServer
+from render import RenderProcess
+from profiler import Profiler
+from recording import MessageRecorder
 
 CONFIG_PATH_DEFAULT = os.path.expanduser("~/printer_data/config/status_led.cfg")
 SOCKET_PATH_DEFAULT = os.path.expanduser("~/printer_data/comms/klippy.sock")
 LOG_PATH_DEFAULT = os.path.expanduser("~/printer_data/logs/status_led.log")
 POLLING_INTERVAL_S = 0.25
-MAX_NUM_REQUESTS_IN_BUFFER = 5
+LIVENESS_INTERVAL_S = 2.0
+MAX_NUM_REQUESTS_IN_FLIGHT = 5
+# The query interval is stretched to this multiple of the round-trip time
+QUERY_INTERVAL_RTT_FACTOR = 4
+MAX_QUERY_INTERVAL_S = 4.0
+LATENCY_LOG_INTERVAL_S = 60.0
+
+# "subscribe": Klipper pushes state changes, "info" is only polled as a liveness check
+# "poll": query all states every POLLING_INTERVAL_S
+UPDATE_MODES = ("subscribe", "poll")
+
+# All messages meant for this service contain one of these
+MESSAGE_MARKERS = (b'"ksl-', b'"set_status_led"')
 
 argParser = argparse.ArgumentParser(
     prog="Klipper Status LED script",
@@ -29,56 +47,65 @@ argParser.add_argument("-c", "--config", default=CONFIG_PATH_DEFAULT)
 argParser.add_argument("-s", "--socket", default=SOCKET_PATH_DEFAULT)
 argParser.add_argument("-l", "--log", default=LOG_PATH_DEFAULT)
 argParser.add_argument("-v", "--verbose", action="store_true", default=False)
-
-
-def createSocket(socketPath):
-    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-    sock.setblocking(0)
-    logging.info("Waiting for connection to '%s'", socketPath)
-
-    while True:
-        try:
-            sock.connect(socketPath)
-        except OSError as e:
-            if e.errno == errno.ECONNREFUSED:
-                time.sleep(0.1)
-                continue
-            elif e.errno == errno.ENOENT:
-                # No such file or directory
-                logging.error(
-                    "Unable to open socket at '%s': No such file or directory. "
-                    "Check your config or the --socket option.",
-                    socketPath,
-                )
-            else:
-                logging.error(
-                    "Unable to open socket at '%s' [%d, %s]\n",
-                    socketPath,
-                    e.errno,
-                    errno.errorcode[e.errno],
-                )
-
-            log.flushAndExit(e.errno)
-        break
-
-    logging.info("Connected.")
-    return sock
+argParser.add_argument(
+    "--profile",
+    action="store_true",
+    default=False,
+    help="sample stacks into collapsed stack files next to the log",
+)
+argParser.add_argument(
+    "--profile-memory",
+    action="store_true",
+    default=False,
+    help="also report the top allocations with tracemalloc, implies --profile",
+)
+argParser.add_argument(
+    "--record",
+    help="record the klippy messages to this file for bench/replay.py",
+)
 
 
 class StatusMonitor:
-    def __init__(self, config, socketPathFallback):
+    def __init__(
+        self, config, socketPathFallback, led=None, printer=None, recorder=None
+    ):
         self.config = config
+        # Optional MessageRecorder of the klippy traffic
+        self.recorder = recorder
 
         self.sock = None
-        self.poll = None
+        self.loop = None
 
-        self.socketPath = config.get(
-            "status_led", "klippy_uds_path", fallback=socketPathFallback
+        # Each printer has its own monitor, all of them sharing one LED
+        printer = printer or config.parsedPrinters[0]
+        self.printerName = printer["name"]
+
+        self.socketPath = printer["config"].get(
+            "klippy_uds_path", fallback=socketPathFallback
+        )
+        self.socketWatcher = SocketWatcher(self.socketPath)
+        self.framer = MessageFramer(MESSAGE_MARKERS)
+        self.requests = RequestManager()
+
+        self.updateMode = printer["config"].get(
+            "update_mode",
+            fallback=config.get("status_led", "update_mode", fallback="subscribe"),
+        )
+        if self.updateMode not in UPDATE_MODES:
+            logging.warning(
+                "Unknown update_mode '%s', using 'subscribe'.", self.updateMode
+            )
+            self.updateMode = "subscribe"
+        self.queryInterval = (
+            LIVENESS_INTERVAL_S
+            if self.updateMode == "subscribe"
+            else POLLING_INTERVAL_S
         )
-        self.carriedData = b""
 
         self.isConnected = False
-        
+        self.hasConnected = False
+        self.numReconnects = 0
+
         # possible states: "ready", "startup", "error", "shutdown"
         self.lastKlipperState = (
             ""
@@ -86,39 +113,124 @@ class StatusMonitor:
         # possible states: "standby", "printing", "paused", "cancelled", "error", "complete"
         self.lastPrintState = ""
         self.lastGcodeState = ""
+        # Sections showing another state than the printer, set by G-code
+        self.sectionStates = {}
 
-        self.ledState = None
+        self.currentState = "unknown"
 
-        self.led = AnimatedLED(config)
+        self.led = led or AnimatedLED(config)
         self.updateLEDState()
 
-    def connect(self):
-        self.sock = createSocket(self.socketPath)
+    async def connect(self):
+        self.sock = await connectSocket(self.socketPath, self.socketWatcher)
 
         if self.sock:
             self.isConnected = True
+            if self.hasConnected:
+                self.numReconnects += 1
+            self.hasConnected = True
+            self.onConnected()
+
+    def onConnected(self):
+        if self.recorder:
+            self.recorder.recordEvent(self.printerName, "connected")
+
+        self.framer.reset()
+        self.requests.reset()
+
+        # Klipper reports its states again on the new connection
+        self.lastKlipperState = ""
+        self.lastPrintState = ""
+
+    def onDisconnected(self):
+        if self.recorder:
+            self.recorder.recordEvent(self.printerName, "disconnected")
 
-            self.poll = select.poll()
-            self.poll.register(self.sock, select.POLLIN | select.POLLHUP)
+        self.isConnected = False
+        self.updateLEDState()
 
     def registerRemoteMethods(self):
-        ledStateMethodCmd = '{"id": "ksl-set-state-reg", "method": "register_remote_method", "params": {"response_template": {"action": "set_status_led"}, "remote_method": "set_status_led"}}'
+        self.sendRequest(
+            "register_remote_method",
+            {
+                "response_template": {"action": "set_status_led"},
+                "remote_method": "set_status_led",
+            },
+            self.onRemoteMethodRegistered,
+        )
+
+    def onRemoteMethodRegistered(self, result):
+        logging.info("Remote method 'set_status_led' registered.")
+
+    def subscribeStatus(self):
+        # Status changes are pushed as {"action": "ksl-status", "params": {...}}
+        self.sendRequest(
+            "objects/subscribe",
+            {
+                "objects": self.getStatusObjects(
+                    {"print_stats": ["state"], "webhooks": ["state"]}
+                ),
+                "response_template": {"action": "ksl-status"},
+            },
+            self.onSubscribed,
+        )
+
+    def getStatusObjects(self, objects):
+        # Fields shown by value effects are requested along with the states
+        objects = {name: list(fields) for name, fields in objects.items()}
+        for name, fields in self.config.valueObjects.items():
+            objects[name] = sorted(set(objects.get(name, [])).union(fields))
+        return objects
 
-        self.sendRequest(ledStateMethodCmd)
+    def onSubscribed(self, result):
+        logging.info("Subscribed to status updates.")
+        return self.applyStatus(result["status"])
 
     def queryStatus(self):
-        infoCmd = '{"id": "ksl-info", "method": "info", "params": {}}'
-        statsCmd = '{"id": "ksl-stats", "method": "objects/query", "params": {"objects": {"print_stats": ["state"]}}}'
+        # Only one query of each kind is in flight at a time
+        if not self.requests.isPending("info"):
+            self.sendRequest("info", {}, self.onInfo)
 
-        self.sendRequest(infoCmd)
-        if self.lastKlipperState == "ready":
-            self.sendRequest(statsCmd)
+        if (
+            self.updateMode == "poll"
+            and self.lastKlipperState == "ready"
+            and not self.requests.isPending("objects/query")
+        ):
+            self.sendRequest(
+                "objects/query",
+                {"objects": self.getStatusObjects({"print_stats": ["state"]})},
+                self.onQueried,
+            )
+
+    def onInfo(self, result):
+        return self.applyKlipperState(result["state"])
+
+    def onQueried(self, result):
+        return self.applyStatus(result["status"])
+
+    # Handler of the responses to each method, used when replaying
+    # a recording of requests sent by another process
+    def getResponseHandler(self, method):
+        return {
+            "register_remote_method": self.onRemoteMethodRegistered,
+            "objects/subscribe": self.onSubscribed,
+            "info": self.onInfo,
+            "objects/query": self.onQueried,
+        }.get(method)
+
+    def sendRequest(self, method, params, handler):
+        requestId, data = self.requests.create(method, params, handler)
+        if self.recorder:
+            self.recorder.recordRequest(self.printerName, method, requestId)
 
-    def sendRequest(self, jsonStr):
         try:
-            return self.sock.send(jsonStr.encode() + b"\x03")
+            return self.sock.send(data)
+        except BlockingIOError:
+            logging.warning("Socket buffer full, request dropped.")
+            self.requests.cancel(requestId)
         except BrokenPipeError:
             logging.warning("Broken pipe.")
+            self.requests.cancel(requestId)
             self.isConnected = False
 
             self.updateLEDState()
@@ -131,48 +243,184 @@ class StatusMonitor:
             and "params" in parsed
             and parsed["action"] == "set_status_led"
         ):
-            if "state" in parsed["params"]:
-                newState = parsed["params"]["state"]
-
-                if self.lastGcodeState != newState:
-                    self.lastGcodeState = newState
-                    stateHasChanged = True
-                    logging.debug(
-                        "Gcode state: %s",
-                        self.lastGcodeState if self.lastGcodeState else "[None]",
-                    )
+            stateHasChanged = self.applyRemoteParams(parsed["params"])
 
-            elif "enabled" in parsed["params"]:
-                logging.debug("se: %s", bool(parsed["params"]["enabled"]))
-                self.led.setEnabled(bool(parsed["params"]["enabled"]))
+        elif "action" in parsed and parsed["action"] == "ksl-status":
+            stateHasChanged = self.applyStatus(parsed["params"]["status"])
 
         elif "id" in parsed:
-            if parsed["id"] == "ksl-set-state-reg":
-                logging.info("Remote method 'set_status_led' registered.")
-
-            elif parsed["id"] == "ksl-info":
-                newState = parsed["result"]["state"]
+            wasUnresponsive = self.requests.isUnresponsive
+            handler = self.requests.resolve(parsed["id"])
 
-                if self.lastKlipperState != newState:
-                    self.lastKlipperState = newState
-                    self.lastGcodeState = ""
-                    stateHasChanged = True
-                    logging.debug("Klipper state: %s", self.lastKlipperState)
+            if wasUnresponsive:
+                logging.info("Klipper '%s' is responsive again.", self.printerName)
+                stateHasChanged = True
 
-            elif parsed["id"] == "ksl-stats":
-                newState = parsed["result"]["status"]["print_stats"]["state"]
+            if "error" in parsed:
+                logging.warning(
+                    "Request '%s' failed: %s", parsed["id"], parsed["error"]
+                )
 
-                if self.lastPrintState != newState:
-                    self.lastPrintState = newState
-                    self.lastGcodeState = ""
-                    stateHasChanged = True
-                    logging.debug("Print state: %s", self.lastPrintState)
+            elif handler and handler(parsed["result"]):
+                stateHasChanged = True
 
         if stateHasChanged:
             self.updateLEDState()
 
+    # Parameters of set_status_led, from G-code or the control socket.
+    # A call may batch several updates, which are applied in order after
+    # its own parameters, so that the LED only needs to be updated once.
+    def applyRemoteParams(self, params):
+        updates, errors = self.checkRemoteParams(params)
+        for error in errors:
+            logging.warning("Ignoring set_status_led parameter: %s", error)
+        return self.applyRemoteUpdates(updates)
+
+    # Splits set_status_led parameters into their updates. Parameters of the
+    # wrong type are left out and described in the returned errors, so that
+    # nothing invalid is ever stored.
+    def checkRemoteParams(self, params):
+        errors = []
+        if not isinstance(params, dict):
+            return [], ["parameters are not an object"]
+
+        updates = [params]
+        if "updates" in params:
+            if isinstance(params["updates"], list):
+                updates += params["updates"]
+            else:
+                errors.append("'updates' is not a list")
+
+        checkedUpdates = []
+        for update in updates:
+            if not isinstance(update, dict):
+                errors.append("update %r is not an object" % (update,))
+                continue
+
+            checked = {}
+            if "state" in update:
+                if isinstance(update["state"], str):
+                    checked["state"] = update["state"]
+                else:
+                    errors.append("state %r is not a string" % (update["state"],))
+
+            sections = update.get("sections", {})
+            if not isinstance(sections, dict):
+                errors.append("'sections' is not an object")
+                sections = {}
+
+            sectionNames = self.config.getSectionNames(self.printerName)
+            checked["sections"] = {}
+            for sectionName, sectionState in sections.items():
+                if sectionName not in sectionNames:
+                    errors.append(
+                        "unknown section '%s' for '%s'"
+                        % (sectionName, self.printerName)
+                    )
+                elif sectionState is not None and not isinstance(sectionState, str):
+                    errors.append(
+                        "state %r of section '%s' is not a string"
+                        % (sectionState, sectionName)
+                    )
+                else:
+                    checked["sections"][sectionName] = sectionState
+
+            if "enabled" in update:
+                checked["enabled"] = bool(update["enabled"])
+
+            checkedUpdates.append(checked)
+
+        return checkedUpdates, errors
+
+    def applyRemoteUpdates(self, updates):
+        stateHasChanged = False
+        for update in updates:
+            if self.applyGcodeUpdate(update):
+                stateHasChanged = True
+        return stateHasChanged
+
+    def applyGcodeUpdate(self, update):
+        stateHasChanged = False
+
+        if "state" in update:
+            newState = update["state"]
+
+            if self.lastGcodeState != newState:
+                self.lastGcodeState = newState
+                stateHasChanged = True
+                logging.debug(
+                    "Gcode state: %s",
+                    self.lastGcodeState if self.lastGcodeState else "[None]",
+                )
+
+        # An empty state removes the override of a section
+        for sectionName, sectionState in update["sections"].items():
+            if sectionState:
+                newState = "gcode_" + sectionState
+                if self.sectionStates.get(sectionName) == newState:
+                    continue
+                self.sectionStates[sectionName] = newState
+            elif self.sectionStates.pop(sectionName, None) is None:
+                continue
+
+            stateHasChanged = True
+            logging.debug(
+                "Gcode state of section '%s': %s",
+                sectionName,
+                sectionState if sectionState else "[None]",
+            )
+
+        if "enabled" in update:
+            logging.debug("se: %s", update["enabled"])
+            self.led.setEnabled(update["enabled"], self.printerName)
+
+        return stateHasChanged
+
+    def applyStatus(self, status):
+        stateHasChanged = False
+
+        if "state" in status.get("print_stats", {}):
+            newState = status["print_stats"]["state"]
+
+            if self.lastPrintState != newState:
+                self.lastPrintState = newState
+                self.lastGcodeState = ""
+                self.sectionStates = {}
+                stateHasChanged = True
+                logging.debug("Print state: %s", self.lastPrintState)
+
+        if "state" in status.get("webhooks", {}):
+            if self.applyKlipperState(status["webhooks"]["state"]):
+                stateHasChanged = True
+
+        if self.config.valueRefs:
+            self.led.updateValues(status, self.printerName)
+
+        return stateHasChanged
+
+    def applyKlipperState(self, newState):
+        if self.lastKlipperState == newState:
+            return False
+
+        self.lastKlipperState = newState
+        self.lastGcodeState = ""
+        self.sectionStates = {}
+        logging.debug("Klipper state: %s", self.lastKlipperState)
+
+        # print_stats may not have been available when subscribing
+        # before Klipper was ready
+        if (
+            self.updateMode == "subscribe"
+            and newState == "ready"
+            and self.lastPrintState == ""
+        ):
+            self.subscribeStatus()
+
+        return True
+
     def updateLEDState(self):
         stateStr = "unknown"
+        sectionStates = None
         if self.isConnected:
             if self.lastGcodeState != "":
                 stateStr = "gcode_" + self.lastGcodeState
@@ -181,64 +429,136 @@ class StatusMonitor:
             else:
                 stateStr = "klipper_" + self.lastKlipperState
 
-        self.led.updateState(self.config.getLEDStateBySection(stateStr))
-
-    def processFromSocket(self):
-        data = None
-        try:
-            data = self.sock.recv(4096)
-        except Exception as e:  # pylint: disable=W0718
-            logging.warning("Error reading from socket:\n%s\n", e)
-
-        if not data:
-            logging.warning("Socket closed.")
-            self.isConnected = False
-            return
+            # Only shown if configured, otherwise the last state is kept
+            if self.requests.isUnresponsive and self.config.isStateConfigured(
+                "klipper_unresponsive"
+            ):
+                stateStr = "klipper_unresponsive"
+            else:
+                sectionStates = self.sectionStates
 
-        # logging.info("recv")
+        self.currentState = stateStr
+        self.led.setState(stateStr, self.printerName, sectionStates)
 
-        parts = data.split(b"\x03")
-        parts[0] = self.carriedData + parts[0]
-        self.carriedData = parts.pop()
+    def processFromSocket(self):
+        self.framer.dispatch(self.handleMessageSafely)
 
-        for line in parts:
+    # A bad message must not stop the other messages, nor the other printers
+    def handleMessageSafely(self, line):
+        try:
             self.handleMessage(line)
+        except Exception as e:  # pylint: disable=W0718
+            logging.exception(
+                "Error handling message from '%s':\n%s\n", self.printerName, e
+            )
 
     def handleMessage(self, line):
-        parsed = json.loads(line.decode())
+        if self.recorder:
+            self.recorder.recordMessage(self.printerName, line)
+
+        parsed = parseMessage(line)
         # logging.info(f"GOT: {parsed}")
         self.updateStatusFromSocket(parsed)
 
-    def run(self):
-        nextTime = time.time()
-        requestsInBuffer = 0
+    async def readFromSocket(self):
+        while self.isConnected:
+            received = 0
+            try:
+                received = await self.framer.receive(self.loop, self.sock)
+            except Exception as e:  # pylint: disable=W0718
+                logging.warning("Error reading from socket:\n%s\n", e)
+
+            if not received:
+                logging.warning("Socket closed.")
+                self.isConnected = False
+                return
+
+            self.processFromSocket()
+
+    def getQueryInterval(self):
+        # Query less often when Klipper is slow to respond
+        rtt = self.requests.smoothedRtt
+        if rtt is None:
+            return self.queryInterval
+
+        return min(
+            max(self.queryInterval, rtt * QUERY_INTERVAL_RTT_FACTOR),
+            MAX_QUERY_INTERVAL_S,
+        )
+
+    def logLatency(self):
+        latency = self.requests.latency
+        if latency.count:
+            logging.debug(
+                "Klipper round-trip time: %d requests, mean %.1f ms, p50 < %.1f ms, p99 < %.1f ms, %d timeouts",
+                latency.count,
+                latency.sum / latency.count * 1000,
+                latency.quantile(0.5) * 1000,
+                latency.quantile(0.99) * 1000,
+                self.requests.numTimeouts,
+            )
+
+    async def scheduleRequests(self):
+        nextTime = self.loop.time()
+        nextLatencyLogTime = nextTime + LATENCY_LOG_INTERVAL_S
+
+        while self.isConnected:
+            wasUnresponsive = self.requests.isUnresponsive
+            if self.requests.expire() and not wasUnresponsive:
+                logging.warning("Klipper '%s' is unresponsive.", self.printerName)
+                self.updateLEDState()
+
+            # Stop sending when Klipper is unresponsive
+            # to prevent overloading
+            # When there are too many pending requests,
+            # Klipper may be unable to handle them
+            if self.requests.numInFlight() < MAX_NUM_REQUESTS_IN_FLIGHT:
+                self.queryStatus()
+
+            if self.loop.time() >= nextLatencyLogTime:
+                self.logLatency()
+                nextLatencyLogTime += LATENCY_LOG_INTERVAL_S
+
+            nextTime = max(nextTime + self.getQueryInterval(), self.loop.time())
+            await asyncio.sleep(nextTime - self.loop.time())
+
+    async def monitorConnection(self):
+        self.loop = asyncio.get_running_loop()
+
+        # Reconnecting only waits on the loop, animations
+        # and the monitors of other printers keep running
+        self.socketWatcher.start()
 
         while True:
-            if not self.isConnected:
-                self.connect()
+            await self.connect()
 
-                if self.isConnected:
-                    self.registerRemoteMethods()
+            self.registerRemoteMethods()
+            if self.updateMode == "subscribe":
+                self.subscribeStatus()
 
-                nextTime = time.time()
-                requestsInBuffer = 0
-            else:
-                res = self.poll.poll(1000.0)
-                for _ in res:
-                    self.processFromSocket()
-                    requestsInBuffer = requestsInBuffer - 1
+            schedulerTask = asyncio.create_task(self.scheduleRequests())
+            try:
+                await self.readFromSocket()
+            finally:
+                schedulerTask.cancel()
+                self.sock.close()
 
-                # Stop sending when Klipper is unresponsive
-                # to prevent overloading
-                # When there are too many pending requests,
-                # Klipper may be unable to handle them
-                if requestsInBuffer < MAX_NUM_REQUESTS_IN_BUFFER:
-                    self.queryStatus()
+            self.onDisconnected()
 
-                    requestsInBuffer = requestsInBuffer + 1
+    async def run(self):
+        # Socket reader and request scheduler run in monitorConnection(),
+        # the animation ticker in the LED's run()
+        await asyncio.gather(self.monitorConnection(), self.led.run())
 
-                nextTime = max(nextTime + POLLING_INTERVAL_S, time.time())
-                time.sleep(max(0, nextTime - time.time()))
+
+async def runMonitors(monitors, led, servers=()):
+    for server in servers:
+        await server.start()
+
+    # All printers are multiplexed on one event loop
+    await asyncio.gather(
+        *(monitor.monitorConnection() for monitor in monitors), led.run()
+    )
 
 
 def main():
@@ -256,8 +576,39 @@ def main():
 
         log.start(logPath)
 
-        monitor = StatusMonitor(config, args.socket)
-        monitor.run()
+        profileOptions = None
+        if args.profile or args.profile_memory:
+            profileOptions = (logPath, args.profile_memory)
+            Profiler(logPath, "profile", args.profile_memory).start()
+
+        # Rendering and output may run in a separate process,
+        # so that socket handling never delays frames
+        if config.getboolean("status_led", "render_process", fallback=False):
+            led = RenderProcess(config, args.config, args.verbose, profileOptions)
+        else:
+            led = AnimatedLED(config)
+
+        recorder = MessageRecorder(args.record) if args.record else None
+        monitors = [
+            StatusMonitor(config, args.socket, led, printer, recorder)
+            for printer in config.parsedPrinters
+        ]
+
+        servers = []
+        metricsAddress = config.get("status_led", "metrics_address", fallback=None)
+        if metricsAddress:
+            servers.append(MetricsServer(metricsAddress, led, monitors))
+        controlSocketPath = config.get(
+            "status_led", "control_socket_path", fallback=None
+        )
+        if controlSocketPath:
+            servers.append(ControlServer(controlSocketPath, monitors))
+
+        try:
+            asyncio.run(runMonitors(monitors, led, servers))
+        finally:
+            if recorder:
+                recorder.close()
     except InvalidConfigException:
         log.start(logPath)
         log.flushAndExit(1)
@@ -0,0 +1,226 @@
+# pylint: disable=C0103
+
+import os
+import logging
+import asyncio
+
+from log import log
+
+METRICS_PREFIX = "klipper_status_led_"
+# Upper bounds of the frame render and show() duration histograms
+FRAME_TIME_BUCKETS_S = (
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+)
+
+# Type, name, help and getter of the metrics of each StatusMonitor
+MONITOR_METRICS = (
+    (
+        "histogram",
+        "klippy_rtt_seconds",
+        "Round-trip time of requests to klippy",
+        lambda monitor: monitor.requests.latency,
+    ),
+    (
+        "gauge",
+        "klippy_requests_in_flight",
+        "Requests without a response",
+        lambda monitor: monitor.requests.numInFlight(),
+    ),
+    (
+        "counter",
+        "klippy_request_timeouts_total",
+        "Requests which timed out",
+        lambda monitor: monitor.requests.numTimeouts,
+    ),
+    (
+        "counter",
+        "klippy_reconnects_total",
+        "Connections to klippy after the first one",
+        lambda monitor: monitor.numReconnects,
+    ),
+    (
+        "gauge",
+        "klippy_connected",
+        "Whether the klippy socket is connected",
+        lambda monitor: int(monitor.isConnected),
+    ),
+)
+
+
+# Frame timing of an AnimatedLED, also when it runs in another process
+class FrameStats:
+    def __init__(
+        self, renderTime, showTime, jitter, numFrames, numLateFrames, numSkippedFrames
+    ):
+        self.renderTime = renderTime
+        self.showTime = showTime
+        self.jitter = jitter
+        self.numFrames = numFrames
+        self.numLateFrames = numLateFrames
+        self.numSkippedFrames = numSkippedFrames
+
+
+def formatLabels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join(
+        '%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for name, value in labels.items()
+    )
+
+
+def formatBound(bound):
+    return "+Inf" if bound == float("inf") else repr(float(bound))
+
+
+class MetricsWriter:
+    def __init__(self):
+        self.lines = []
+        self.declared = set()
+
+    def declare(self, name, metricType, helpText):
+        if name in self.declared:
+            return
+        self.declared.add(name)
+        self.lines.append("# HELP %s%s %s" % (METRICS_PREFIX, name, helpText))
+        self.lines.append("# TYPE %s%s %s" % (METRICS_PREFIX, name, metricType))
+
+    def sample(self, name, value, labels=None):
+        self.lines.append(
+            "%s%s%s %s" % (METRICS_PREFIX, name, formatLabels(labels), value)
+        )
+
+    def gauge(self, name, helpText, value, labels=None):
+        self.declare(name, "gauge", helpText)
+        self.sample(name, value, labels)
+
+    def counter(self, name, helpText, value, labels=None):
+        self.declare(name, "counter", helpText)
+        self.sample(name, value, labels)
+
+    # Writes a klippy.LatencyHistogram, whose bucket counts are not cumulative
+    def histogram(self, name, helpText, histogram, labels=None):
+        self.declare(name, "histogram", helpText)
+        labels = labels or {}
+
+        cumulative = 0
+        for bound, count in zip(histogram.buckets + (float("inf"),), histogram.counts):
+            cumulative += count
+            self.sample(
+                name + "_bucket", cumulative, dict(labels, le=formatBound(bound))
+            )
+        self.sample(name + "_sum", histogram.sum, labels)
+        self.sample(name + "_count", histogram.count, labels)
+
+    def text(self):
+        return "\n".join(self.lines) + "\n"
+
+
+# Serves the counters kept by the LED and the monitors in the Prometheus
+# text format over HTTP. They are only read when scraped.
+class MetricsServer:
+    def __init__(self, address, led, monitors):
+        self.address = address
+        self.led = led
+        self.monitors = monitors
+        self.server = None
+
+    async def start(self):
+        # "unix:<path>" for a socket, otherwise "[host:]port" on localhost
+        if self.address.startswith("unix:"):
+            path = self.address[len("unix:") :]
+            if os.path.exists(path):
+                os.unlink(path)
+            self.server = await asyncio.start_unix_server(self.handleClient, path)
+        else:
+            host, _, port = self.address.rpartition(":")
+            self.server = await asyncio.start_server(
+                self.handleClient, host or "127.0.0.1", int(port)
+            )
+
+        logging.info("Serving metrics on '%s'", self.address)
+
+    def close(self):
+        if self.server:
+            self.server.close()
+
+    async def handleClient(self, reader, writer):
+        try:
+            # The request itself does not matter, every path gets the metrics
+            await reader.readuntil(b"\r\n\r\n")
+
+            body = self.render().encode()
+            writer.write(
+                b"HTTP/1.0 200 OK\r\n"
+                b"Content-Type: text/plain; version=0.0.4\r\n"
+                b"Content-Length: %d\r\n\r\n" % len(body) + body
+            )
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, OSError):
+            pass
+        finally:
+            writer.close()
+
+    def render(self):
+        metrics = MetricsWriter()
+        stats = self.led.getFrameStats()
+
+        metrics.histogram(
+            "frame_render_seconds",
+            "Time to render the frame buffers",
+            stats.renderTime,
+        )
+        metrics.histogram(
+            "frame_show_seconds",
+            "Time to write changed frame buffers to the outputs",
+            stats.showTime,
+        )
+        metrics.counter("frames_total", "Frames shown", stats.numFrames)
+        metrics.counter(
+            "late_frames_total",
+            "Animation frames rendered later than scheduled",
+            stats.numLateFrames,
+        )
+        metrics.counter(
+            "skipped_frames_total",
+            "Animation frames dropped to catch up after late frames",
+            stats.numSkippedFrames,
+        )
+        metrics.histogram(
+            "frame_jitter_seconds",
+            "Delay of animation frames after their scheduled time",
+            stats.jitter,
+        )
+
+        # Samples of a metric have to be grouped, so the monitors are
+        # iterated per metric
+        for metricType, name, helpText, getValue in MONITOR_METRICS:
+            for monitor in self.monitors:
+                getattr(metrics, metricType)(
+                    name, helpText, getValue(monitor), {"printer": monitor.printerName}
+                )
+
+        for monitor in self.monitors:
+            metrics.gauge(
+                "state",
+                "Currently shown state",
+                1,
+                {"printer": monitor.printerName, "state": monitor.currentState},
+            )
+
+        metrics.gauge(
+            "log_queue_depth",
+            "Log records waiting to be written",
+            log.queue.qsize() if log.queue else 0,
+        )
+
+        return metrics.text()
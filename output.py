@@ -0,0 +1,196 @@
+# pylint: disable=C0103
+
+import os
+import mmap
+import logging
+
+# Hardware modules are only imported by the output type in use.
+# Blinka's platform detection in particular is slow on small boards.
+
+# PWM capable pins and their PWM channel, used by rpi_ws281x
+WS281X_CHANNELS = {12: 0, 18: 0, 13: 1, 19: 1}
+# SPI bit patterns for a 0 and a 1 bit at SPI_FREQUENCY_HZ
+SPI_FREQUENCY_HZ = 6400000
+SPI_BIT_PATTERNS = (0b11000000, 0b11110000)
+# Low time of >80 us to latch the data
+SPI_RESET_BYTES = 64
+# Largest write spidev passes on as a single transfer
+SPIDEV_BUFSIZ_PATH = "/sys/module/spidev/parameters/bufsiz"
+
+
+def pinNumber(pinName):
+    if not pinName.startswith("D") or not pinName[1:].isdigit():
+        raise ValueError("Unknown pin '%s'" % pinName)
+    return int(pinName[1:])
+
+
+class NeoPixelOutput:
+    def __init__(self, options, count, bpp):
+        import board  # pylint: disable=C0415
+        import digitalio  # pylint: disable=C0415
+        from neopixel_write import neopixel_write  # pylint: disable=C0415
+
+        pinName = options.get("pin")
+        pinNumber(pinName)
+
+        self.neopixelWrite = neopixel_write
+        self.pin = digitalio.DigitalInOut(getattr(board, pinName))
+        self.pin.direction = digitalio.Direction.OUTPUT
+
+    def show(self, buf):
+        self.neopixelWrite(self.pin, buf)
+
+
+class Ws281xOutput:
+    def __init__(self, options, count, bpp):
+        import rpi_ws281x  # pylint: disable=C0415
+
+        pin = pinNumber(options.get("pin"))
+        if pin not in WS281X_CHANNELS:
+            raise ValueError("Pin D%d does not support PWM" % pin)
+
+        # The frame buffer is already in wire order,
+        # so the pixels are passed on without reordering
+        self.strip = rpi_ws281x.PixelStrip(
+            count,
+            pin,
+            dma=options.getint("dma", fallback=10),
+            channel=WS281X_CHANNELS[pin],
+            strip_type=(
+                rpi_ws281x.ws.SK6812_STRIP_RGBW
+                if bpp == 4
+                else rpi_ws281x.ws.WS2811_STRIP_RGB
+            ),
+        )
+        self.strip.begin()
+
+        self.bpp = bpp
+        self.lastFrame = None
+
+    def show(self, buf):
+        last = self.lastFrame
+        if last == buf:
+            return
+
+        # The bindings only set single pixels, so only changed ones are set.
+        # Pixels are compared through views instead of copies.
+        bpp = self.bpp
+        with memoryview(buf) as view, memoryview(last or buf) as lastView:
+            for start in range(0, len(buf), bpp):
+                pixel = view[start : start + bpp]
+                if last is None or pixel != lastView[start : start + bpp]:
+                    # 0xWWRRGGBB with the wire order bytes as RGB(W)
+                    value = int.from_bytes(pixel[:3], "big")
+                    if bpp == 4:
+                        value |= pixel[3] << 24
+                    self.strip.setPixelColor(start // bpp, value)
+
+        if last is None:
+            self.lastFrame = bytearray(buf)
+        else:
+            last[:] = buf
+        self.strip.show()
+
+
+class SpiOutput:
+    def __init__(self, options, count, bpp):
+        import spidev  # pylint: disable=C0415
+
+        self.spi = spidev.SpiDev()
+        self.spi.open(
+            options.getint("spi_bus", fallback=0),
+            options.getint("spi_device", fallback=0),
+        )
+        self.spi.max_speed_hz = SPI_FREQUENCY_HZ
+        self.spi.mode = 0
+
+        # Each data byte becomes 8 SPI bytes, one per bit. Byte k of each
+        # group is translated from the data with the table of bit 7 - k and
+        # written into every 8th byte of the bitstream, so that encoding a
+        # frame takes 8 translations instead of a lookup per byte.
+        self.tables = [
+            bytes(SPI_BIT_PATTERNS[(value >> bit) & 1] for value in range(256))
+            for bit in range(7, -1, -1)
+        ]
+        self.dataSize = count * bpp * 8
+        self.bitstream = bytearray(self.dataSize + SPI_RESET_BYTES)
+
+        # spidev splits larger writes into several transfers, and a pause
+        # between them may latch a partial frame
+        bufsiz = readSpidevBufsiz()
+        if bufsiz is not None and len(self.bitstream) > bufsiz:
+            logging.warning(
+                "A frame of %d LEDs takes %d SPI bytes, more than the %d of "
+                "spidev.bufsiz, and may flicker. Add spidev.bufsiz=%d to "
+                "/boot/cmdline.txt.",
+                count,
+                len(self.bitstream),
+                bufsiz,
+                len(self.bitstream),
+            )
+
+    def show(self, buf):
+        bitstream = self.bitstream
+        for k, table in enumerate(self.tables):
+            bitstream[k : self.dataSize : 8] = buf.translate(table)
+
+        # The bitstream is clocked out by the SPI controller's DMA
+        self.spi.writebytes2(bitstream)
+
+
+def readSpidevBufsiz():
+    try:
+        with open(SPIDEV_BUFSIZ_PATH, encoding="utf-8") as f:
+            return int(f.read())
+    except (OSError, ValueError):
+        return None
+
+
+class FileOutput:
+    def __init__(self, options, count, bpp):
+        self.path = options.get("output_path", fallback="/dev/shm/status_led.raw")
+
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            os.ftruncate(fd, count * bpp)
+            self.map = mmap.mmap(fd, count * bpp)
+        finally:
+            os.close(fd)
+
+    def show(self, buf):
+        self.map[:] = buf
+
+
+class NullOutput:
+    def __init__(self, options, count, bpp):
+        pass
+
+    def show(self, buf):
+        pass
+
+
+# Output types which need a pin definition
+PIN_OUTPUT_TYPES = ("neopixel", "ws281x")
+# Output types driven by rpi_ws281x, Blinka's neopixel_write included. Every
+# strip of it resets the one PWM block of the SoC and claims its DMA channel,
+# so only one of these outputs can run, whichever PWM channel it uses.
+PWM_OUTPUT_TYPES = ("neopixel", "ws281x")
+
+OUTPUT_TYPES = {
+    "neopixel": NeoPixelOutput,
+    "ws281x": Ws281xOutput,
+    "spi": SpiOutput,
+    "file": FileOutput,
+    "null": NullOutput,
+}
+
+
+def createOutput(outputType, options, count, bpp):
+    if outputType not in OUTPUT_TYPES:
+        raise ValueError(
+            "Unknown output '%s', expected one of %s"
+            % (outputType, ", ".join(OUTPUT_TYPES))
+        )
+
+    logging.info("Initializing '%s' output", outputType)
+    return OUTPUT_TYPES[outputType](options, count, bpp)
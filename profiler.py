@@ -0,0 +1,171 @@
+# pylint: disable=C0103
+
+import os
+import sys
+import time
+import logging
+import threading
+import tracemalloc
+
+# Stacks of all threads are sampled this often. A sample takes some tens
+# to a few hundred microseconds, about 1% of a core. The measured cost is
+# logged with every interval.
+PROFILE_SAMPLE_INTERVAL_S = 0.02
+# A new set of files is started this often
+PROFILE_ROTATE_INTERVAL_S = 300
+# Files of this many intervals are kept, older ones are deleted
+PROFILE_KEEP_FILES = 12
+# Stacks are cut at this depth
+PROFILE_MAX_DEPTH = 64
+# Distinct stacks per interval, further ones are counted as "[other]"
+PROFILE_MAX_STACKS = 5000
+# Frames kept per allocation by tracemalloc, more cost more memory and time
+TRACEMALLOC_FRAMES = 1
+TOP_ALLOCATIONS = 25
+
+
+# Samples the stacks of all threads of this process into collapsed stack
+# files, which flamegraph.pl, speedscope or inferno read directly.
+# Optionally reports the top allocations of each interval with tracemalloc.
+class Profiler:
+    # Files are named after the log file and placed next to it
+    def __init__(self, logPath, name="profile", traceMemory=False):
+        self.directory = os.path.dirname(logPath) or "."
+        self.prefix = "%s-%s" % (
+            os.path.splitext(os.path.basename(logPath))[0],
+            name,
+        )
+        self.traceMemory = traceMemory
+
+        self.stacks = {}
+        # Frame label of each code object, formatted once
+        self.labels = {}
+        self.numSamples = 0
+        self.samplingTime = 0.0
+        self.lastSnapshot = None
+        self.thread = None
+
+    def start(self):
+        if self.traceMemory:
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+
+        self.thread = threading.Thread(
+            target=self.run, name="ksl-profiler", daemon=True
+        )
+        self.thread.start()
+
+        logging.info(
+            "Profiling to '%s' every %ss%s",
+            os.path.join(self.directory, self.prefix + "-*"),
+            PROFILE_ROTATE_INTERVAL_S,
+            " with allocation tracing" if self.traceMemory else "",
+        )
+
+    def run(self):
+        intervalStart = time.monotonic()
+        while True:
+            time.sleep(PROFILE_SAMPLE_INTERVAL_S)
+
+            sampleStart = time.thread_time()
+            self.sample()
+            self.samplingTime += time.thread_time() - sampleStart
+
+            now = time.monotonic()
+            if now - intervalStart >= PROFILE_ROTATE_INTERVAL_S:
+                self.writeInterval(now - intervalStart)
+                intervalStart = now
+
+    def sample(self):
+        threadNames = {thread.ident: thread.name for thread in threading.enumerate()}
+        ownIdent = threading.get_ident()
+
+        for ident, frame in sys._current_frames().items():  # pylint: disable=W0212
+            if ident == ownIdent:
+                continue
+
+            frames = []
+            while frame is not None and len(frames) < PROFILE_MAX_DEPTH:
+                code = frame.f_code
+                label = self.labels.get(code)
+                if label is None:
+                    label = "%s (%s)" % (
+                        code.co_name,
+                        os.path.basename(code.co_filename),
+                    )
+                    self.labels[code] = label
+                frames.append(label)
+                frame = frame.f_back
+
+            frames.append(threadNames.get(ident, str(ident)))
+            stack = ";".join(reversed(frames))
+
+            if stack not in self.stacks and len(self.stacks) >= PROFILE_MAX_STACKS:
+                stack = "[other]"
+            self.stacks[stack] = self.stacks.get(stack, 0) + 1
+
+        self.numSamples += 1
+
+    def writeInterval(self, duration):
+        name = "%s-%s" % (self.prefix, time.strftime("%Y%m%d-%H%M%S"))
+        stacks = self.stacks
+        self.stacks = {}
+
+        try:
+            with open(
+                os.path.join(self.directory, name + ".folded"), "w", encoding="utf-8"
+            ) as f:
+                for stack, count in sorted(stacks.items()):
+                    f.write("%s %d\n" % (stack, count))
+
+            if self.traceMemory:
+                self.writeAllocations(os.path.join(self.directory, name + ".alloc"))
+
+            self.deleteOldFiles()
+        except OSError as e:
+            logging.warning("Unable to write profile '%s': %s", name, e)
+
+        logging.info(
+            "Profile '%s': %d samples, sampling used %.2f%% of a CPU",
+            name,
+            self.numSamples,
+            100 * self.samplingTime / duration,
+        )
+        self.numSamples = 0
+        self.samplingTime = 0.0
+
+    def writeAllocations(self, path):
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+            (
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, "<frozen importlib._bootstrap*"),
+            )
+        )
+        current, peak = tracemalloc.get_traced_memory()
+
+        with open(path, "w", encoding="utf-8") as f:
+            f.write("Traced memory: %d bytes, peak %d bytes\n" % (current, peak))
+
+            f.write("\nTop allocations:\n")
+            for stat in snapshot.statistics("lineno")[:TOP_ALLOCATIONS]:
+                f.write("%s\n" % stat)
+
+            if self.lastSnapshot is not None:
+                f.write("\nGrowth since the last interval:\n")
+                for stat in snapshot.compare_to(self.lastSnapshot, "lineno")[
+                    :TOP_ALLOCATIONS
+                ]:
+                    f.write("%s\n" % stat)
+
+        self.lastSnapshot = snapshot
+        tracemalloc.reset_peak()
+
+    def deleteOldFiles(self):
+        for extension in (".folded", ".alloc"):
+            # Timestamps in the names sort chronologically
+            names = sorted(
+                name
+                for name in os.listdir(self.directory)
+                if name.startswith(self.prefix + "-") and name.endswith(extension)
+            )
+            for name in names[:-PROFILE_KEEP_FILES]:
+                os.remove(os.path.join(self.directory, name))
@@ -0,0 +1,49 @@
+# pylint: disable=C0103
+
+import json
+import time
+import logging
+
+
+# Captures the traffic of all monitors for bench/replay.py, one JSON object
+# per line with the monotonic time in seconds:
+#   {"t": 1.5, "printer": "default", "event": "connected"}
+#   {"t": 1.5, "printer": "default", "send": "info", "id": "ksl-3"}
+#   {"t": 1.6, "printer": "default", "recv": "{\"id\": \"ksl-3\", ...}"}
+# Received messages are kept as framed, so that replaying them parses the
+# same bytes. Only the method and id of requests are needed to replay
+# the responses. Every entry is flushed right away, since the service is
+# usually stopped with SIGTERM, which skips any cleanup.
+class MessageRecorder:
+    def __init__(self, path):
+        self.path = path
+        # pylint: disable=R1732
+        self.file = open(path, "w", encoding="utf-8")
+
+        logging.info("Recording klippy messages to '%s'", path)
+
+    def write(self, printerName, entry):
+        self.file.write(
+            json.dumps(
+                {"t": round(time.monotonic(), 6), "printer": printerName, **entry}
+            )
+            + "\n"
+        )
+        self.file.flush()
+
+    def recordEvent(self, printerName, event):
+        self.write(printerName, {"event": event})
+
+    def recordRequest(self, printerName, method, requestId):
+        self.write(printerName, {"send": method, "id": requestId})
+
+    def recordMessage(self, printerName, data):
+        self.write(printerName, {"recv": bytes(data).decode(errors="replace")})
+
+    def close(self):
+        self.file.close()
+
+
+def readRecording(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
@@ -0,0 +1,383 @@
+# pylint: disable=C0103
+
+import os
+import math
+import struct
+import logging
+import asyncio
+import multiprocessing
+from multiprocessing import shared_memory
+
+from log import log
+from klippy import LatencyHistogram
+from clock import JITTER_BUCKETS_S
+from metrics import FRAME_TIME_BUCKETS_S
+from metrics import FrameStats
+from config import StatusLEDConfig
+from led import AnimatedLED
+from profiler import Profiler
+
+# The render process publishes its frame stats this often
+STATS_INTERVAL_S = 1.0
+
+SEQUENCE = struct.Struct("<Q")
+
+
+# Single writer, single reader slot in shared memory. The writer makes the
+# sequence number odd while writing, so the reader can tell a torn read
+# from a complete one without any lock.
+class SeqlockRegion:
+    def __init__(self, buf, offset, layout):
+        self.buf = buf
+        self.offset = offset
+        self.layout = struct.Struct("<" + layout)
+        self.size = SEQUENCE.size + self.layout.size
+
+        self.sequence = 0
+        self.lastReadSequence = None
+
+    def write(self, values):
+        self.sequence += 1
+        SEQUENCE.pack_into(self.buf, self.offset, self.sequence)
+        self.layout.pack_into(self.buf, self.offset + SEQUENCE.size, *values)
+        self.sequence += 1
+        SEQUENCE.pack_into(self.buf, self.offset, self.sequence)
+
+    # Returns the values if they changed since the last read, None otherwise
+    def read(self):
+        sequence = SEQUENCE.unpack_from(self.buf, self.offset)[0]
+        if sequence & 1 or sequence == self.lastReadSequence:
+            return None
+
+        values = self.layout.unpack_from(self.buf, self.offset + SEQUENCE.size)
+        if SEQUENCE.unpack_from(self.buf, self.offset)[0] != sequence:
+            return None
+
+        self.lastReadSequence = sequence
+        return values
+
+
+# Shared memory holding the published state of each printer and the frame
+# stats of the render process. States are passed as indices into the
+# compiled plans, which both processes build from the same config.
+class PlanSlot:
+    def __init__(self, config, name=None):
+        self.printerNames = [printer["name"] for printer in config.parsedPrinters]
+        # Index 0 is for states without a plan, which use the fallback
+        self.stateNames = [None] + sorted(config.statePlans[self.printerNames[0]])
+        self.stateIds = {name: i for i, name in enumerate(self.stateNames) if name}
+        self.sectionNames = {
+            printerName: config.getSectionNames(printerName)
+            for printerName in self.printerNames
+        }
+        # Values of each printer are NaN until received
+        self.valueKeys = [
+            (printerName, ref)
+            for printerName in self.printerNames
+            for ref in sorted(config.valueRefs)
+        ]
+
+        # State id, enabled flag and section overrides per printer, then
+        # the values. Overrides hold the state id plus one, 0 for none.
+        planLayout = "".join(
+            "IB" + "I" * len(self.sectionNames[printerName])
+            for printerName in self.printerNames
+        )
+        planLayout += "d" * len(self.valueKeys)
+        statsLayout = "d" * len(flattenFrameStats(emptyFrameStats()))
+        size = (
+            2 * SEQUENCE.size
+            + struct.calcsize("<" + planLayout)
+            + struct.calcsize("<" + statsLayout)
+        )
+
+        self.memory = shared_memory.SharedMemory(
+            name=name, create=name is None, size=size
+        )
+        self.name = self.memory.name
+
+        self.plan = SeqlockRegion(self.memory.buf, 0, planLayout)
+        self.stats = SeqlockRegion(self.memory.buf, self.plan.size, statsLayout)
+
+    def close(self, unlink=False):
+        # The regions hold views of the buffer
+        self.plan = self.stats = None
+        self.memory.close()
+        if unlink:
+            self.memory.unlink()
+
+
+def emptyFrameStats():
+    return FrameStats(
+        LatencyHistogram(FRAME_TIME_BUCKETS_S),
+        LatencyHistogram(FRAME_TIME_BUCKETS_S),
+        LatencyHistogram(JITTER_BUCKETS_S),
+        0,
+        0,
+        0,
+    )
+
+
+def flattenFrameStats(stats):
+    values = [stats.numFrames, stats.numLateFrames, stats.numSkippedFrames]
+    for histogram in (stats.renderTime, stats.showTime, stats.jitter):
+        values += histogram.counts
+        values += [histogram.count, histogram.sum]
+    return values
+
+
+def unflattenFrameStats(values):
+    stats = emptyFrameStats()
+    stats.numFrames, stats.numLateFrames, stats.numSkippedFrames = (
+        int(value) for value in values[:3]
+    )
+
+    offset = 3
+    for histogram in (stats.renderTime, stats.showTime, stats.jitter):
+        numCounts = len(histogram.counts)
+        histogram.counts = [int(value) for value in values[offset : offset + numCounts]]
+        histogram.count = int(values[offset + numCounts])
+        histogram.sum = values[offset + numCounts + 1]
+        offset += numCounts + 2
+
+    return stats
+
+
+# Stands in for AnimatedLED in the monitor process. State changes are
+# written to the slot and announced with a byte on the doorbell pipe.
+# Nothing is ever waited for, a full pipe already has a wake-up pending.
+class RenderProcess:
+    def __init__(self, config, configPath, isVerbose, profileOptions=None):
+        self.slot = PlanSlot(config)
+
+        self.stateIds = [0] * len(self.slot.printerNames)
+        self.enabled = [1] * len(self.slot.printerNames)
+        self.sectionStateIds = [
+            [0] * len(self.slot.sectionNames[printerName])
+            for printerName in self.slot.printerNames
+        ]
+        self.values = [math.nan] * len(self.slot.valueKeys)
+        self.valueIndices = {key: i for i, key in enumerate(self.slot.valueKeys)}
+        self.lastFrameStats = emptyFrameStats()
+
+        # Spawned instead of forked, so that no event loop, threads
+        # or hardware state of this process are inherited
+        context = multiprocessing.get_context("spawn")
+        doorbellReader, self.doorbell = context.Pipe(duplex=False)
+        os.set_blocking(self.doorbell.fileno(), False)
+
+        self.process = context.Process(
+            target=runRenderProcess,
+            args=(
+                configPath,
+                self.slot.name,
+                doorbellReader,
+                log.createProcessQueue(context),
+                isVerbose,
+                profileOptions,
+            ),
+            name="ksl-render",
+            daemon=True,
+        )
+        self.process.start()
+        doorbellReader.close()
+
+        logging.info("Started render process %d", self.process.pid)
+
+    def publish(self):
+        values = []
+        for stateId, enabled, sectionStateIds in zip(
+            self.stateIds, self.enabled, self.sectionStateIds
+        ):
+            values += (stateId, enabled, *sectionStateIds)
+        self.slot.plan.write(values + self.values)
+
+        try:
+            os.write(self.doorbell.fileno(), b"\x01")
+        except BlockingIOError:
+            pass
+
+    def setState(self, stateName, printerName="default", sectionStates=None):
+        logging.debug("Publishing state '%s' for '%s'", stateName, printerName)
+
+        printerIndex = self.slot.printerNames.index(printerName)
+        self.stateIds[printerIndex] = self.slot.stateIds.get(stateName, 0)
+
+        sectionStates = sectionStates or {}
+        self.sectionStateIds[printerIndex] = [
+            (
+                self.slot.stateIds.get(sectionStates[sectionName], 0) + 1
+                if sectionName in sectionStates
+                else 0
+            )
+            for sectionName in self.slot.sectionNames[printerName]
+        ]
+        self.publish()
+
+    def setEnabled(self, enabled, printerName="default"):
+        self.enabled[self.slot.printerNames.index(printerName)] = int(enabled)
+        self.publish()
+
+    def updateValues(self, status, printerName="default"):
+        hasChanged = False
+        for objectName, fields in status.items():
+            for field, value in fields.items():
+                index = self.valueIndices.get((printerName, objectName + "." + field))
+                if index is None:
+                    continue
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    continue
+
+                if self.values[index] != value:
+                    self.values[index] = value
+                    hasChanged = True
+
+        if hasChanged:
+            self.publish()
+
+    def getFrameStats(self):
+        values = self.slot.stats.read()
+        if values is not None:
+            self.lastFrameStats = unflattenFrameStats(values)
+        return self.lastFrameStats
+
+    async def run(self):
+        await asyncio.get_running_loop().run_in_executor(None, self.process.join)
+
+        logging.error("Render process exited with code %s.", self.process.exitcode)
+        log.flushAndExit(1)
+
+    def close(self):
+        self.doorbell.close()
+        self.process.join()
+        self.slot.close(unlink=True)
+
+
+# Applies the states published in the slot to the AnimatedLED
+# of the render process
+class PlanReceiver:
+    def __init__(self, slot, led, doorbell):
+        self.slot = slot
+        self.led = led
+        self.doorbell = doorbell
+        self.lastPlan = None
+        self.closed = None
+
+    def applyPlan(self):
+        plan = self.slot.plan.read()
+        if plan is None:
+            return
+
+        slot = self.slot
+        lastPlan = self.lastPlan
+        self.lastPlan = plan
+
+        offset = 0
+        for printerName in slot.printerNames:
+            sectionNames = slot.sectionNames[printerName]
+            end = offset + 2 + len(sectionNames)
+
+            if (
+                lastPlan is None
+                or lastPlan[offset] != plan[offset]
+                or lastPlan[offset + 2 : end] != plan[offset + 2 : end]
+            ):
+                sectionStates = {
+                    sectionName: slot.stateNames[sectionStateId - 1]
+                    for sectionName, sectionStateId in zip(
+                        sectionNames, plan[offset + 2 : end]
+                    )
+                    if sectionStateId
+                }
+                self.led.setState(
+                    slot.stateNames[plan[offset]], printerName, sectionStates
+                )
+            if lastPlan is None or lastPlan[offset + 1] != plan[offset + 1]:
+                self.led.setEnabled(bool(plan[offset + 1]), printerName)
+
+            offset = end
+
+        valueOffset = offset
+        statusByPrinter = {}
+        for i, (printerName, ref) in enumerate(slot.valueKeys):
+            value = plan[valueOffset + i]
+            if math.isnan(value):
+                continue
+
+            objectName, field = ref.rsplit(".", 1)
+            statusByPrinter.setdefault(printerName, {}).setdefault(objectName, {})[
+                field
+            ] = value
+
+        for printerName, status in statusByPrinter.items():
+            self.led.updateValues(status, printerName)
+
+    def onDoorbell(self):
+        try:
+            data = os.read(self.doorbell.fileno(), 4096)
+        except BlockingIOError:
+            return
+
+        if not data:
+            # The monitor process exited
+            self.closed.set()
+            return
+
+        self.applyPlan()
+
+    async def publishStats(self):
+        while True:
+            self.slot.stats.write(flattenFrameStats(self.led.getFrameStats()))
+            await asyncio.sleep(STATS_INTERVAL_S)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        self.closed = asyncio.Event()
+
+        os.set_blocking(self.doorbell.fileno(), False)
+        loop.add_reader(self.doorbell.fileno(), self.onDoorbell)
+
+        # States published before this process was ready
+        self.applyPlan()
+
+        tasks = [
+            asyncio.create_task(self.led.run()),
+            asyncio.create_task(self.publishStats()),
+        ]
+        await self.closed.wait()
+
+        for task in tasks:
+            task.cancel()
+        loop.remove_reader(self.doorbell.fileno())
+
+
+# The profile options are the log path and whether to trace allocations
+def runRenderProcess(
+    configPath, slotName, doorbell, logQueue, isVerbose, profileOptions=None
+):
+    log.initProcessQueue(logQueue, isVerbose)
+
+    if profileOptions:
+        logPath, traceMemory = profileOptions
+        Profiler(logPath, "render-profile", traceMemory).start()
+
+    # The monitor process already logged the config
+    rootLogger = logging.getLogger()
+    level = rootLogger.level
+    rootLogger.setLevel(logging.WARNING)
+    config = StatusLEDConfig()
+    config.load(configPath)
+    rootLogger.setLevel(level)
+
+    slot = PlanSlot(config, slotName)
+    led = AnimatedLED(config)
+    # Startup is measured from the monitor process, which spawned this one
+    led.servicePid = os.getppid()
+
+    logging.info("Render process ready")
+    try:
+        asyncio.run(PlanReceiver(slot, led, doorbell).run())
+    finally:
+        led.close()
+        slot.close()
+        log.flush()